@@ -1,19 +1,29 @@
+import hashlib
+import logging
 import os
 import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import streamlit as st
 from dotenv import load_dotenv
 from openai import OpenAI
 
 from llm_extractor import (
+    extract_highlights_from_pdf,
     extract_highlights_from_pdf_fullcontext,
     explain_page,
+    make_client,
+    retrieve_highlights_batch,
+    submit_highlights_batch,
     summarize_document,
 )
-from pdf_highlighter import extract_text_per_page, highlight_pdf
+from pdf_highlighter import extract_text_per_page, highlight_pdf, render_pages_png
 
 
 load_dotenv()
+logging.basicConfig(level=logging.WARNING)
 
 st.set_page_config(page_title="Case Copilot", layout="wide")
 
@@ -21,10 +31,18 @@ st.title("Case Copilot")
 st.caption("Read the case, get guided summaries, and auto-highlights.")
 
 
+# Auto-highlights are stored column-wise (one list per field, aligned by index)
+HIGHLIGHT_COLUMNS = ("page", "quote", "label", "note")
+
+
+def to_highlight_columns(highlights: list) -> dict:
+    return {col: [h.get(col, "") for h in highlights] for col in HIGHLIGHT_COLUMNS}
+
+
 if "pages" not in st.session_state:
     st.session_state.pages = []
 if "highlights" not in st.session_state:
-    st.session_state.highlights = []
+    st.session_state.highlights = to_highlight_columns([])
 if "summary" not in st.session_state:
     st.session_state.summary = {}
 if "page_explanations" not in st.session_state:
@@ -37,6 +55,16 @@ if "pdf_name" not in st.session_state:
     st.session_state.pdf_name = None
 if "highlighted_pdf_path" not in st.session_state:
     st.session_state.highlighted_pdf_path = None
+if "highlight_job" not in st.session_state:
+    st.session_state.highlight_job = None
+if "highlight_error" not in st.session_state:
+    st.session_state.highlight_error = None
+if "highlights_batch_id" not in st.session_state:
+    st.session_state.highlights_batch_id = None
+if "pdf_hash" not in st.session_state:
+    st.session_state.pdf_hash = None
+if "upload_id" not in st.session_state:
+    st.session_state.upload_id = None
 
 
 with st.sidebar:
@@ -55,44 +83,285 @@ with st.sidebar:
     render_zoom = st.slider("PDF zoom", min_value=1.0, max_value=3.0, value=2.0, step=0.1)
 
 
+@st.cache_resource(show_spinner=False)
+def _make_client(api_key: str) -> OpenAI:
+    # One client per key keeps its connection pool (and warm TLS) across reruns
+    return make_client(api_key)
+
+
 def get_client() -> OpenAI:
     api_key = os.getenv("OPENAI_API_KEY") if use_env_key else api_key_input
     if not api_key:
         st.warning("Set OPENAI_API_KEY in .env or uncheck and enter it in the sidebar.")
         return None
-    return OpenAI(api_key=api_key)
+    return _make_client(api_key)
+
+
+# Rendered page PNGs and uploaded PDFs persist here across sessions and server restarts
+RENDER_CACHE_DIR = os.path.join(tempfile.gettempdir(), "case_copilot_pages")
+UPLOAD_CACHE_DIR = os.path.join(tempfile.gettempdir(), "case_copilot_uploads")
+
+
+# Open documents kept for page rendering; older ones are dropped (and freed)
+# as other files are viewed
+DOC_CACHE_ENTRIES = 8
+
+
+@st.cache_resource(show_spinner=False, max_entries=DOC_CACHE_ENTRIES)
+def _open_doc(file_path: str, mtime: float):
+    # Parsed once per file version and shared by every page render;
+    # mtime is part of the key so a rewritten file is reopened.
+    # Only use the document while holding _doc_lock(file_path).
+    import fitz  # PyMuPDF
+
+    return fitz.open(file_path)
+
+
+@st.cache_resource(show_spinner=False)
+def _doc_lock(file_path: str) -> threading.Lock:
+    # _open_doc documents are shared by every session's script thread (uploads
+    # are content-addressed, so two users on the same case get the same one),
+    # and PyMuPDF must not be used from two threads at once.
+    return threading.Lock()
+
+
+def _page_cache_path(file_path: str, page_num: int, zoom: float) -> str:
+    mtime = os.path.getmtime(file_path)
+    key = hashlib.sha1(f"{file_path}:{mtime}:{page_num}:{zoom}".encode("utf-8")).hexdigest()
+    return os.path.join(RENDER_CACHE_DIR, f"{key}.png")
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # Write to a temp file then rename so readers never see a partial file
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as tmp:
+        tmp.write(data)
+    os.replace(tmp.name, path)
 
 
 @st.cache_data(show_spinner=False)
 def render_page_image(file_path: str, page_num: int, zoom: float) -> bytes:
     import fitz  # PyMuPDF
 
-    doc = fitz.open(file_path)
-    page = doc[page_num - 1]
-    mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    doc.close()
-    return pix.tobytes("png")
+    cache_path = _page_cache_path(file_path, page_num, zoom)
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            return f.read()
+
+    with _doc_lock(file_path):
+        doc = _open_doc(file_path, os.path.getmtime(file_path))
+        page = doc[page_num - 1]
+        mat = fitz.Matrix(zoom, zoom)
+        pix = page.get_pixmap(matrix=mat, alpha=False)
+        png = pix.tobytes("png")
+    _write_atomic(cache_path, png)
+    return png
+
+
+def prerender_pages(file_path: str, page_nums: list, zoom: float) -> None:
+    """
+    Rasterize pages missing from the disk cache in parallel worker processes,
+    so the per-page render_page_image calls that follow are cache hits.
+    """
+    missing = {p: _page_cache_path(file_path, p, zoom) for p in page_nums}
+    missing = {p: path for p, path in missing.items() if not os.path.exists(path)}
+    if len(missing) < 2:
+        return
+    pngs = render_pages_png(file_path, list(missing), zoom)
+    for cache_path, png in zip(missing.values(), pngs):
+        _write_atomic(cache_path, png)
+
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def store_upload(uploaded) -> tuple:
+    """
+    Copy an uploaded PDF into the content-addressed upload cache in fixed-size
+    chunks, hashing as it goes. Returns (sha256 hex digest, cached path).
+    """
+    os.makedirs(UPLOAD_CACHE_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    uploaded.seek(0)
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+        for chunk in iter(lambda: uploaded.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+    pdf_hash = digest.hexdigest()
+    pdf_path = os.path.join(UPLOAD_CACHE_DIR, f"{pdf_hash}.pdf")
+    if os.path.exists(pdf_path):
+        os.remove(tmp.name)
+    else:
+        os.replace(tmp.name, pdf_path)
+    return pdf_hash, pdf_path
+
+
+@st.cache_data(show_spinner=False)
+def cached_pages(pdf_hash: str, _pdf_path: str) -> list:
+    return extract_text_per_page(_pdf_path)
+
+
+# LLM results are cached on (pdf_hash, settings) so reruns and re-uploads of the
+# same document don't pay for the same call twice. Underscore args aren't hashed.
+# Empty results raise so failures are never cached.
+LLM_CACHE_TTL = 24 * 3600
+
+
+@st.cache_data(show_spinner=False, ttl=LLM_CACHE_TTL)
+def cached_summary(pdf_hash: str, model: str, max_context_chars: int, _client, _pages) -> dict:
+    summary = summarize_document(
+        _client, _pages, model=model, max_context_chars=max_context_chars
+    )
+    if not summary:
+        raise RuntimeError("Summary generation failed")
+    return summary
+
+
+@st.cache_data(show_spinner=False, ttl=LLM_CACHE_TTL)
+def cached_highlights(
+    pdf_hash: str, model: str, max_context_chars: int, full_context: bool, _client, _pages
+) -> list:
+    if full_context:
+        highlights = extract_highlights_from_pdf_fullcontext(
+            _client, _pages, model=model, max_context_chars=max_context_chars
+        )
+    else:
+        highlights = extract_highlights_from_pdf(
+            _client, _pages, model=model, max_highlights_per_page=7
+        )
+    if not highlights:
+        raise RuntimeError("Highlight extraction returned no highlights")
+    return highlights
+
+
+@st.cache_resource(show_spinner=False)
+def _explanation_cache() -> dict:
+    # A plain dict rather than st.cache_data: explanations stream into a placeholder
+    # created outside the call, which cache_data cannot replay.
+    return {}
+
+
+def cached_page_explanation(
+    pdf_hash: str, page_num: int, model: str, client, page_text: str, on_text=None
+) -> str:
+    cache = _explanation_cache()
+    key = (pdf_hash, page_num, model)
+    if key not in cache:
+        explanation = explain_page(client, page_num, page_text, model=model, on_text=on_text)
+        if not explanation:
+            raise RuntimeError(f"Explaining page {page_num} failed")
+        cache[key] = explanation
+    return cache[key]
+
+
+@st.cache_resource(show_spinner=False)
+def _annotation_pool() -> ProcessPoolExecutor:
+    # A worker process rather than a thread: PyMuPDF must not be used from two
+    # threads at once, and the script thread keeps rendering pages meanwhile.
+    return ProcessPoolExecutor(max_workers=1)
+
+
+def start_highlighting(highlights: list) -> None:
+    """
+    Annotate a copy of the PDF in the background. poll_highlighting() picks up
+    the result on a later rerun.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as out_tmp:
+        output_path = out_tmp.name
+    job_args = (highlight_pdf, st.session_state.pdf_path, output_path, highlights)
+    try:
+        future = _annotation_pool().submit(*job_args)
+    except BrokenProcessPool:
+        # The worker died (e.g. killed for memory); the pool is unusable from
+        # then on, so replace it
+        _annotation_pool.clear()
+        try:
+            future = _annotation_pool().submit(*job_args)
+        except BrokenProcessPool as e:
+            st.session_state.highlight_error = (highlights, str(e))
+            return
+    st.session_state.highlight_job = (future, output_path, highlights)
+    st.session_state.highlight_error = None
+
+
+def poll_highlighting() -> None:
+    job = st.session_state.highlight_job
+    if not job or not job[0].done():
+        return
+    future, output_path, highlights = job
+    st.session_state.highlight_job = None
+    if future.exception():
+        if isinstance(future.exception(), BrokenProcessPool):
+            _annotation_pool.clear()
+        # Remembered with the highlights it was for, so the same job isn't
+        # restarted on every rerun; a changed selection may try again
+        st.session_state.highlight_error = (highlights, str(future.exception()))
+    else:
+        st.session_state.highlighted_pdf_path = output_path
+
+
+def set_highlights(highlights: list) -> None:
+    st.session_state.highlights = to_highlight_columns(highlights)
+    # The annotated PDF is only built on demand (Show highlighted PDF / Apply)
+    st.session_state.highlighted_pdf_path = None
+    st.session_state.highlight_job = None
+    st.session_state.highlight_error = None
+
+
+def selected_highlights() -> list:
+    """
+    Highlights to write into the PDF: checked auto-highlights with their edited
+    label/note, plus manual highlights.
+    """
+    hl = st.session_state.highlights
+    selected = []
+    for i in range(len(hl["page"])):
+        if st.session_state.get(f"hl_selected_{i}", True):
+            label = st.session_state.get(f"hl_label_{i}", hl["label"][i]).strip()
+            note = st.session_state.get(f"hl_note_{i}", hl["note"][i]).strip()
+            content = label
+            if note:
+                content = f"{label} | {note}" if label else note
+            selected.append({"page": hl["page"][i], "quote": hl["quote"][i], "label": content})
+
+    manual_selected = [
+        {
+            "page": mh["page"],
+            "quote": mh["quote"],
+            "label": mh.get("label", ""),
+        }
+        for mh in st.session_state.manual_highlights
+        if mh.get("quote")
+    ]
+    return selected + manual_selected
 
 
 uploaded = st.file_uploader("Upload a case PDF", type=["pdf"])
 if uploaded is not None:
-    if st.session_state.pdf_name != uploaded.name:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(uploaded.read())
-            st.session_state.pdf_path = tmp.name
-            st.session_state.pdf_name = uploaded.name
-        st.session_state.pages = extract_text_per_page(st.session_state.pdf_path)
-        st.session_state.highlights = []
+    if st.session_state.upload_id != uploaded.file_id:
+        # Store PDFs by content hash so re-uploading the same case skips the parse
+        pdf_hash, pdf_path = store_upload(uploaded)
+        st.session_state.upload_id = uploaded.file_id
+        st.session_state.pdf_path = pdf_path
+        st.session_state.pdf_name = uploaded.name
+        st.session_state.pdf_hash = pdf_hash
+        st.session_state.pages = cached_pages(pdf_hash, pdf_path)
+        st.session_state.highlights = to_highlight_columns([])
         st.session_state.summary = {}
         st.session_state.page_explanations = {}
         st.session_state.manual_highlights = []
         st.session_state.highlighted_pdf_path = None
+        st.session_state.highlight_job = None
+        st.session_state.highlight_error = None
+        st.session_state.highlights_batch_id = None
 
 
 if not st.session_state.pdf_path:
     st.stop()
 
+poll_highlighting()
+
 left, right = st.columns([2, 1])
 
 with left:
@@ -102,6 +371,20 @@ with left:
         "Show highlighted PDF",
         value=st.session_state.highlighted_pdf_path is not None,
     )
+    if (
+        show_highlighted
+        and not st.session_state.highlighted_pdf_path
+        and not st.session_state.highlight_job
+    ):
+        to_apply = selected_highlights()
+        failed = st.session_state.highlight_error
+        if failed and failed[0] == to_apply:
+            st.error(f"Highlighting the PDF failed: {failed[1]}")
+        elif to_apply:
+            start_highlighting(to_apply)
+    if st.session_state.highlight_job:
+        st.caption("Annotating PDF in the background...")
+        st.button("Refresh", key="refresh_highlight_job")
     pdf_path_to_render = (
         st.session_state.highlighted_pdf_path
         if show_highlighted and st.session_state.highlighted_pdf_path
@@ -113,6 +396,7 @@ with left:
         img_bytes = render_page_image(pdf_path_to_render, page_choice, render_zoom)
         st.image(img_bytes, use_container_width=True)
     else:
+        prerender_pages(pdf_path_to_render, page_numbers, render_zoom)
         for p in page_numbers:
             st.markdown(f"**Page {p}**")
             img_bytes = render_page_image(pdf_path_to_render, p, render_zoom)
@@ -125,12 +409,16 @@ with right:
         client = get_client()
         if client:
             with st.spinner("Summarizing..."):
-                st.session_state.summary = summarize_document(
-                    client,
-                    st.session_state.pages,
-                    model=model,
-                    max_context_chars=int(max_context_chars),
-                )
+                try:
+                    st.session_state.summary = cached_summary(
+                        st.session_state.pdf_hash,
+                        model,
+                        int(max_context_chars),
+                        client,
+                        st.session_state.pages,
+                    )
+                except RuntimeError as e:
+                    st.error(str(e))
 
     if st.session_state.summary:
         st.markdown("**Summary**")
@@ -145,84 +433,77 @@ with right:
     st.divider()
 
     use_full_context = st.checkbox("Use full-document context", value=True)
+    use_batch = st.checkbox(
+        "Batch mode (cheaper, async)",
+        value=False,
+        help="Queue per-page extraction on the OpenAI Batch API at half the cost. "
+        "Results usually arrive within minutes (up to 24h).",
+    )
     if st.button("Generate Highlights", use_container_width=True):
         client = get_client()
-        if client:
+        if client and use_batch:
+            with st.spinner("Queuing batch..."):
+                st.session_state.highlights_batch_id = submit_highlights_batch(
+                    client, st.session_state.pages, model=model
+                )
+            if not st.session_state.highlights_batch_id:
+                st.error("Could not queue the highlights batch.")
+        elif client:
             with st.spinner("Extracting highlights..."):
-                if use_full_context:
-                    highlights = extract_highlights_from_pdf_fullcontext(
+                try:
+                    highlights = cached_highlights(
+                        st.session_state.pdf_hash,
+                        model,
+                        int(max_context_chars),
+                        use_full_context,
                         client,
                         st.session_state.pages,
-                        model=model,
-                        max_context_chars=int(max_context_chars),
                     )
+                except RuntimeError as e:
+                    st.error(str(e))
+                    highlights = []
+                set_highlights(highlights)
+
+    if st.session_state.highlights_batch_id:
+        st.info(f"Highlights batch queued: {st.session_state.highlights_batch_id}")
+        if st.button("Check Batch Status", use_container_width=True):
+            client = get_client()
+            if client:
+                with st.spinner("Checking batch..."):
+                    highlights = retrieve_highlights_batch(
+                        client, st.session_state.highlights_batch_id
+                    )
+                if highlights is None:
+                    st.write("Batch is not ready yet. Check again in a few minutes.")
+                elif not highlights:
+                    # Failed, expired or unparsable: keep the current highlights
+                    st.session_state.highlights_batch_id = None
+                    st.error("The highlights batch failed or returned no highlights.")
                 else:
-                    from llm_extractor import extract_highlights_from_pdf
+                    st.session_state.highlights_batch_id = None
+                    set_highlights(highlights)
+                    st.rerun()
 
-                    highlights = extract_highlights_from_pdf(
-                        client,
-                        st.session_state.pages,
-                        model=model,
-                        max_highlights_per_page=7,
-                    )
-                for h in highlights:
-                    h.setdefault("label", "")
-                    h.setdefault("note", "")
-                st.session_state.highlights = highlights
-                # Auto-apply highlights to generate an annotated PDF for viewing
-                if highlights:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as out_tmp:
-                        output_path = out_tmp.name
-                    highlight_pdf(st.session_state.pdf_path, output_path, highlights)
-                    st.session_state.highlighted_pdf_path = output_path
-
-    if st.session_state.highlights:
+    hl = st.session_state.highlights
+    if hl["page"]:
         st.markdown("**Highlights**")
-        for i, h in enumerate(st.session_state.highlights):
+        rows = zip(hl["page"], hl["quote"], hl["label"], hl["note"])
+        for i, (page, quote, label, note) in enumerate(rows):
             selected_key = f"hl_selected_{i}"
-            label_key = f"hl_label_{i}"
-            note_key = f"hl_note_{i}"
 
             if selected_key not in st.session_state:
                 st.session_state[selected_key] = True
 
-            st.checkbox(
-                f"Page {h['page']}", key=selected_key, value=st.session_state[selected_key]
-            )
-            st.write(h["quote"])
-            st.text_input("Label", key=label_key, value=h.get("label", ""))
-            st.text_area("Note", key=note_key, value=h.get("note", ""), height=80)
+            st.checkbox(f"Page {page}", key=selected_key, value=st.session_state[selected_key])
+            st.write(quote)
+            st.text_input("Label", key=f"hl_label_{i}", value=label)
+            st.text_area("Note", key=f"hl_note_{i}", value=note, height=80)
 
         if st.button("Apply Highlights to PDF", use_container_width=True):
-            selected = []
-            for i, h in enumerate(st.session_state.highlights):
-                if st.session_state.get(f"hl_selected_{i}"):
-                    label = st.session_state.get(f"hl_label_{i}", "").strip()
-                    note = st.session_state.get(f"hl_note_{i}", "").strip()
-                    content = label
-                    if note:
-                        content = f"{label} | {note}" if label else note
-                    h_out = {
-                        "page": h["page"],
-                        "quote": h["quote"],
-                        "label": content,
-                    }
-                    selected.append(h_out)
-
-            manual_selected = [
-                {
-                    "page": mh["page"],
-                    "quote": mh["quote"],
-                    "label": mh.get("label", ""),
-                }
-                for mh in st.session_state.manual_highlights
-                if mh.get("quote")
-            ]
-
-            if selected or manual_selected:
+            all_highlights = selected_highlights()
+            if all_highlights:
                 with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as out_tmp:
                     output_path = out_tmp.name
-                all_highlights = selected + manual_selected
                 highlight_pdf(st.session_state.pdf_path, output_path, all_highlights)
                 st.session_state.highlighted_pdf_path = output_path
                 with open(output_path, "rb") as f:
@@ -242,10 +523,22 @@ with right:
             client = get_client()
             if client:
                 page_text = st.session_state.pages[explain_page_choice - 1]["text"]
+                placeholder = st.empty()
                 with st.spinner("Explaining page..."):
-                    st.session_state.page_explanations[explain_page_choice] = explain_page(
-                        client, explain_page_choice, page_text, model=model
-                    )
+                    try:
+                        st.session_state.page_explanations[explain_page_choice] = (
+                            cached_page_explanation(
+                                st.session_state.pdf_hash,
+                                explain_page_choice,
+                                model,
+                                client,
+                                page_text,
+                                on_text=placeholder.markdown,
+                            )
+                        )
+                    except RuntimeError as e:
+                        st.error(str(e))
+                placeholder.empty()
 
         if explain_page_choice in st.session_state.page_explanations:
             st.write(st.session_state.page_explanations[explain_page_choice])
@@ -0,0 +1,84 @@
+"""
+Persistent exact-match cache for LLM responses.
+
+Responses are keyed by a hash of the full request body (model, messages,
+response_format, ...), so re-running on the same PDF with the same prompts
+returns instantly and bills no tokens.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+from typing import Dict, Optional
+
+import orjson
+
+log = logging.getLogger(__name__)
+
+CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "case_highlighter", "llm_cache.sqlite3"
+)
+
+_enabled = True
+
+
+def set_enabled(enabled: bool) -> None:
+    """
+    Turn the cache on or off for this process (e.g. for --no-cache).
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def make_key(body: Dict) -> str:
+    """
+    Stable key for a chat completion request body.
+    """
+    return hashlib.sha256(orjson.dumps(body, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL)"
+    )
+    return conn
+
+
+def get(key: str) -> Optional[str]:
+    """
+    Cached response content for key, or None on a miss (or if disabled).
+    """
+    if not _enabled:
+        return None
+    try:
+        conn = _connect()
+        try:
+            row = conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        log.warning("LLM cache read failed: %s", e)
+        return None
+    return row[0] if row else None
+
+
+def put(key: str, content: str) -> None:
+    """
+    Store response content for key. Failures are logged, never raised.
+    """
+    if not _enabled:
+        return
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, content) VALUES (?, ?)",
+                    (key, content),
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        log.warning("LLM cache write failed: %s", e)
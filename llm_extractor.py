@@ -2,43 +2,131 @@
 LLM integration for extracting important phrases from PDF pages.
 """
 
-import json
-from typing import List, Dict, Optional
-from openai import OpenAI
-
+import asyncio
+import functools
+import hashlib
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Dict, Optional, Tuple
+
+import orjson
+import tiktoken
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    AsyncOpenAI,
+    OpenAI,
+    RateLimitError,
+    Timeout,
+)
+
+import llm_cache
+import semantic_cache
+
+log = logging.getLogger(__name__)
+
+
+HIGHLIGHT_LABELS = ["Problem", "Constraint", "Numbers", "Decision", "Risk", "Insight", "Other"]
+
+# Responses use single-letter labels (and short keys, see _highlights_schema) to
+# keep output tokens down; LABEL_MAP expands them after parsing.
+LABEL_MAP = {label[0]: label for label in HIGHLIGHT_LABELS}
+LABEL_LEGEND = ", ".join(f"{code}={label}" for code, label in LABEL_MAP.items())
 
 SYSTEM_PROMPT = """You extract ONLY verbatim quotes from the provided page text.
-Return JSON. No paraphrases. Your job is to identify the most important phrases that should be highlighted."""
-
-USER_PROMPT_TEMPLATE = """Goal: highlight the most important phrases for case understanding.
+No paraphrases. Your job is to identify the most important phrases that should be highlighted."""
 
-Rules:
-- Choose 3–7 quotes from this page only.
-- Each quote must be copied EXACTLY from the page text (verbatim, no changes).
-- 6–25 words per quote (1 sentence max).
-- Include page number in each highlight.
-- Add a label tag: Problem, Constraint, Numbers, Decision, Risk, Insight, or other relevant category.
-- Output JSON: {{"highlights":[{{"page":<page>, "quote":"...", "label":"..."}}]}}
+# Per-page calls send the static system prompt and rules as leading messages and
+# only the page itself last, so every call shares the same cacheable prefix.
+RULES_MESSAGE = f"""Pick 3–7 quotes (6–25 words, 1 sentence max) copied EXACTLY from the page in the next message that matter most for understanding the case, and label each ({LABEL_LEGEND})."""
 
-Page: {page_num}
+PAGE_MESSAGE_TEMPLATE = """Page: {page_num}
 Text:
 {page_text}
 """
 
-FULL_CONTEXT_SYSTEM_PROMPT = """You extract ONLY verbatim quotes from the provided full document text.
-Return JSON. No paraphrases. Your job is to identify the most important phrases that should be highlighted."""
-
-FULL_CONTEXT_USER_PROMPT_TEMPLATE = """Goal: highlight the most important phrases for case understanding across the entire document.
-
-Rules:
-- Choose 15–35 quotes from the full document (unless the document is very short).
-- Each quote must be copied EXACTLY from the document text (verbatim, no changes).
-- 6–25 words per quote (1 sentence max).
-- Include page number in each highlight.
-- Add a label tag: Problem, Constraint, Numbers, Decision, Risk, Insight, or other relevant category.
-- Output JSON: {{"highlights":[{{"page":<page>, "quote":"...", "label":"..."}}]}}
-
-The document text below includes page markers like:
+# Multi-page calls pack several consecutive pages, with page markers, into one
+# request; the rules message is static so it stays in the cached prefix.
+MULTIPAGE_RULES_MESSAGE = f"""Pick 3–7 quotes per page (6–25 words, 1 sentence max) copied EXACTLY from the pages in the next message that matter most for understanding the case. Give each the page number from its <<<PAGE n>>> marker and a label ({LABEL_LEGEND})."""
+
+
+def _strict_object(properties: Dict) -> Dict:
+    # Strict mode requires every property to be listed as required
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def _highlights_schema(name: str, item_properties: Dict) -> Dict:
+    return {
+        "name": name,
+        "strict": True,
+        "schema": _strict_object(
+            {"h": {"type": "array", "items": _strict_object(item_properties)}}
+        ),
+    }
+
+
+# Structured outputs: the model is constrained to these shapes, so the prompts
+# don't need to describe them and responses always parse. Keys are one letter
+# (h=highlights, p=page, q=quote, l=label) since every highlight repeats them.
+# Per-page calls don't ask for a page number at all; the caller already knows it.
+PAGE_HIGHLIGHTS_SCHEMA = _highlights_schema(
+    "PageHighlights",
+    {
+        "q": {"type": "string"},
+        "l": {"type": "string", "enum": list(LABEL_MAP)},
+    },
+)
+
+HIGHLIGHTS_SCHEMA = _highlights_schema(
+    "Highlights",
+    {
+        "p": {"type": "integer"},
+        "q": {"type": "string"},
+        "l": {"type": "string", "enum": list(LABEL_MAP)},
+    },
+)
+
+PAGE_HIGHLIGHTS_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": PAGE_HIGHLIGHTS_SCHEMA}
+HIGHLIGHTS_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": HIGHLIGHTS_SCHEMA}
+
+SUMMARY_SCHEMA = {
+    "name": "Summary",
+    "strict": True,
+    "schema": _strict_object(
+        {
+            "summary": {"type": "string"},
+            "key_points": {"type": "array", "items": {"type": "string"}},
+            "open_questions": {"type": "array", "items": {"type": "string"}},
+        }
+    ),
+}
+
+# cap_total_highlights gets back indices into the list it sent, not the quotes
+SELECTION_SCHEMA = {
+    "name": "Selection",
+    "strict": True,
+    "schema": _strict_object({"selected": {"type": "array", "items": {"type": "integer"}}}),
+}
+
+# Near-duplicate page results are only reused while the per-page prompt is unchanged
+PAGE_PROMPT_VERSION = hashlib.sha256(
+    (SYSTEM_PROMPT + RULES_MESSAGE + PAGE_MESSAGE_TEMPLATE).encode("utf-8")
+    + orjson.dumps(PAGE_HIGHLIGHTS_SCHEMA, option=orjson.OPT_SORT_KEYS)
+).hexdigest()
+
+# Document-level calls put the (large, stable) document first, in the system
+# message, and the task second. OpenAI's prompt cache keys on the message prefix,
+# so repeated highlight/summary calls on the same document reuse the cached tokens.
+DOCUMENT_SYSTEM_PROMPT_TEMPLATE = """You analyze business case documents.
+Follow the task in the user message.
+
+The document text below may include page markers like:
 <<<PAGE 1>>>
 ...text...
 <<<PAGE 2>>>
@@ -48,30 +136,289 @@ Document:
 {doc_text}
 """
 
-SUMMARY_SYSTEM_PROMPT = """You summarize business case documents.
-Return JSON only. Be concise and structured."""
-
-SUMMARY_USER_PROMPT_TEMPLATE = """Summarize the case document below.
-
-Return JSON with:
-- "summary": 5-8 sentences max
-- "key_points": 6-10 bullet points
-- "open_questions": 3-6 questions a reader should investigate
+FULL_CONTEXT_USER_PROMPT = f"""Pick 15–35 quotes (6–25 words, 1 sentence max) copied EXACTLY from the document above that matter most for understanding the case (fewer if the document is very short). No paraphrases. Give each its page number and a label ({LABEL_LEGEND}).
+"""
 
-Document:
-{doc_text}
+SUMMARY_USER_PROMPT = """Summarize the case document above. Be concise and structured: a summary of 5-8 sentences max, 6-10 key points, and 3-6 open questions a reader should investigate.
 """
 
 PAGE_EXPLAIN_SYSTEM_PROMPT = """You explain a single page from a case document.
 Return plain text. Be concise and helpful."""
 
-PAGE_EXPLAIN_USER_PROMPT_TEMPLATE = """Explain this page in 4-6 sentences.
-Focus on what matters for decision making.
+PAGE_EXPLAIN_RULES_MESSAGE = """Explain the page in the next message in 4-6 sentences.
+Focus on what matters for decision making."""
 
-Page {page_num}:
+PAGE_EXPLAIN_PAGE_TEMPLATE = """Page {page_num}:
 {page_text}
 """
 
+# Max number of in-flight requests when fanning out per-page / per-chunk calls
+DEFAULT_CONCURRENCY = 8
+
+# Fail fast on a stuck request instead of the SDK's 10 minute default. The SDK
+# retries timeouts, connection errors, 429 and 5xx with jittered exponential
+# backoff (honoring Retry-After), so transient rate limits don't drop a page.
+REQUEST_TIMEOUT = Timeout(45.0, connect=5.0)
+# Whole-document prompts and batch uploads legitimately take longer
+DOCUMENT_REQUEST_TIMEOUT = Timeout(180.0, connect=5.0)
+MAX_RETRIES = 3
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Batches expire after their 24h completion window; allow a little beyond that
+BATCH_MAX_WAIT = 25 * 3600.0
+
+# Per-page input token budget. The model context is far larger, but text past
+# this mostly adds cost and 429s on dense pages.
+MODEL_CONTEXT_TOKENS = 128_000
+MAX_OUTPUT_TOKENS = 1_000
+MAX_PAGE_TOKENS = 6_000
+# When truncating would drop more than this fraction of a page, send it as
+# overlapping windows instead and merge the results
+MAX_TRUNCATED_FRACTION = 0.3
+WINDOW_OVERLAP_TOKENS = 200
+# Page text per request when packing several pages into one multi-page call
+DEFAULT_MULTIPAGE_TOKENS = 8_000
+
+
+# Rough text-per-token rate for English, used when the tokenizer is unavailable
+CHARS_PER_TOKEN = 4
+
+# Models whose tiktoken encoding could not be loaded (e.g. offline, where
+# tiktoken can't download it), so the load is only attempted once
+_encoding_failures = set()
+
+
+# Building an encoding is costly, so one is kept per model
+@functools.lru_cache(maxsize=4)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _encoding_or_none(model: str) -> Optional[tiktoken.Encoding]:
+    """
+    The model's encoding, or None if it can't be loaded; token counts are then
+    estimated from characters.
+    """
+    if model in _encoding_failures:
+        return None
+    try:
+        return _get_encoding(model)
+    except Exception as e:
+        _encoding_failures.add(model)
+        log.warning("No tokenizer for %s (%s); estimating tokens from characters", model, e)
+        return None
+
+
+@functools.lru_cache(maxsize=4)
+def _page_token_budget(model: str) -> int:
+    """
+    Page text token budget per request. The static prompt is only tokenized
+    the first time per model (lazily, so importing this module never loads an
+    encoding).
+    """
+    enc = _encoding_or_none(model)
+    static_text = SYSTEM_PROMPT + RULES_MESSAGE
+    if enc is None:
+        static_tokens = len(static_text) // CHARS_PER_TOKEN + 1
+    else:
+        static_tokens = len(enc.encode(static_text))
+    return min(MAX_PAGE_TOKENS, MODEL_CONTEXT_TOKENS - static_tokens - MAX_OUTPUT_TOKENS)
+
+
+def _page_windows(page_num: int, page_text: str, model: str) -> List[str]:
+    """
+    Split page text into the pieces to send to the LLM, each within the page
+    token budget. Almost always this is just [page_text].
+    A page slightly over budget is truncated; a longer one is split into as
+    many overlapping windows as needed to cover all of it.
+    """
+    # BPE never produces more tokens than UTF-8 bytes, so short pages skip encoding
+    if len(page_text.encode("utf-8")) <= MAX_PAGE_TOKENS:
+        return [page_text]
+
+    enc = _encoding_or_none(model)
+    budget = _page_token_budget(model)
+    overlap = WINDOW_OVERLAP_TOKENS
+    if enc is None:
+        # Without a tokenizer the same splitting is done on characters
+        tokens, decode, unit = page_text, str, "characters"
+        budget *= CHARS_PER_TOKEN
+        overlap *= CHARS_PER_TOKEN
+    else:
+        tokens, decode, unit = enc.encode(page_text), enc.decode, "tokens"
+    if len(tokens) <= budget:
+        return [page_text]
+    if 1 - budget / len(tokens) <= MAX_TRUNCATED_FRACTION:
+        log.info(
+            "Page %s: truncating text from %d to %d %s", page_num, len(tokens), budget, unit
+        )
+        return [decode(tokens[:budget])]
+
+    windows = []
+    start = 0
+    while True:
+        windows.append(decode(tokens[start:start + budget]))
+        if start + budget >= len(tokens):
+            break
+        start += budget - overlap
+    log.info(
+        "Page %s: splitting %d %s into %d windows", page_num, len(tokens), unit, len(windows)
+    )
+    return windows
+
+
+def _merge_window_highlights(window_highlights: List[List[Dict]]) -> List[Dict]:
+    """
+    Combine highlights from the windows of one page, dropping repeated quotes
+    (the windows overlap).
+    """
+    seen = set()
+    merged = []
+    for highlights in window_highlights:
+        for h in highlights:
+            if h["quote"] not in seen:
+                seen.add(h["quote"])
+                merged.append(h)
+    return merged
+
+
+def _page_messages(page_num: int, page_text: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": RULES_MESSAGE},
+        {
+            "role": "user",
+            "content": PAGE_MESSAGE_TEMPLATE.format(page_num=page_num, page_text=page_text),
+        },
+    ]
+
+
+def _page_request_body(page_num: int, page_text: str, model: str) -> Dict:
+    return {
+        "model": model,
+        "messages": _page_messages(page_num, page_text),
+        "response_format": PAGE_HIGHLIGHTS_RESPONSE_FORMAT,
+        "temperature": 0.3,  # Lower temperature for more consistent verbatim extraction
+    }
+
+
+def _parse_page_highlights(content: str, page_num: int) -> List[Dict]:
+    return [
+        {"page": page_num, "quote": h["q"], "label": LABEL_MAP[h["l"]]}
+        for h in orjson.loads(content)["h"]
+    ]
+
+
+def _parse_highlights(content: str) -> List[Dict]:
+    return [
+        {"page": h["p"], "quote": h["q"], "label": LABEL_MAP[h["l"]]}
+        for h in orjson.loads(content)["h"]
+    ]
+
+
+def make_client(api_key: str) -> OpenAI:
+    """
+    Build an OpenAI client with this module's timeout and retry settings.
+    """
+    return OpenAI(api_key=api_key, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES)
+
+
+def make_async_client(api_key: str) -> AsyncOpenAI:
+    """
+    Build an AsyncOpenAI client with this module's timeout and retry settings.
+    """
+    return AsyncOpenAI(api_key=api_key, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES)
+
+
+def _async_client_for(client: OpenAI) -> AsyncOpenAI:
+    """
+    Build an AsyncOpenAI client with the same credentials/settings as a sync client.
+    """
+    return AsyncOpenAI(
+        api_key=client.api_key,
+        organization=client.organization,
+        base_url=client.base_url,
+        timeout=client.timeout,
+        max_retries=client.max_retries,
+    )
+
+
+def _complete(
+    client: OpenAI,
+    body: Dict,
+    parse: Callable[[str], Any],
+    what: str,
+    timeout: Optional[Timeout] = None,
+) -> Any:
+    """
+    Run a chat completion through the persistent response cache.
+    The content is parsed before it is cached, so bad responses are never stored.
+    """
+    key = llm_cache.make_key(body)
+    content = llm_cache.get(key)
+    if content is not None:
+        log.info("%s: cache hit", what)
+        return parse(content)
+
+    if timeout is not None:
+        response = client.chat.completions.create(**body, timeout=timeout)
+    else:
+        response = client.chat.completions.create(**body)
+    _log_usage(response, what)
+    content = response.choices[0].message.content
+    result = parse(content)
+    llm_cache.put(key, content)
+    return result
+
+
+async def _complete_async(
+    async_client: AsyncOpenAI,
+    body: Dict,
+    parse: Callable[[str], Any],
+    what: str,
+    timeout: Optional[Timeout] = None,
+) -> Any:
+    """
+    Async version of _complete.
+    """
+    key = llm_cache.make_key(body)
+    content = llm_cache.get(key)
+    if content is not None:
+        log.info("%s: cache hit", what)
+        return parse(content)
+
+    if timeout is not None:
+        response = await async_client.chat.completions.create(**body, timeout=timeout)
+    else:
+        response = await async_client.chat.completions.create(**body)
+    _log_usage(response, what)
+    content = response.choices[0].message.content
+    result = parse(content)
+    llm_cache.put(key, content)
+    return result
+
+
+async def _gather_bounded(
+    func: Callable[[Any], Awaitable[Any]],
+    items: List[Any],
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[Any]:
+    """
+    Run func(item) for all items concurrently with at most `concurrency` in flight.
+    Results are returned in the same order as items.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(item):
+        async with semaphore:
+            return await func(item)
+
+    return await asyncio.gather(*[_one(item) for item in items])
+
+
 def extract_highlights_from_page(
     client: OpenAI, page_num: int, page_text: str, model: str = "gpt-4o-mini"
 ) -> List[Dict]:
@@ -87,36 +434,205 @@ def extract_highlights_from_page(
     Returns:
         List of highlight dicts with "page", "quote", "label" keys
     """
-    prompt = USER_PROMPT_TEMPLATE.format(page_num=page_num, page_text=page_text)
+    cached = _similar_page_highlights(page_num, page_text, model)
+    if cached is not None:
+        return cached
+
+    windows = _page_windows(page_num, page_text, model)
+    results = [_extract_window(client, page_num, window, model) for window in windows]
+    return _finish_page(page_text, model, results)
+
+
+def _similar_page_highlights(page_num: int, page_text: str, model: str) -> Optional[List[Dict]]:
+    """
+    Highlights from a near-identical, previously processed page, moved to page_num.
+    """
+    cached = semantic_cache.get(model, PAGE_PROMPT_VERSION, page_text)
+    if cached is None:
+        return None
+    log.info("Page %s: reusing highlights from a near-identical page", page_num)
+    return [dict(h, page=page_num) for h in cached]
+
 
+def _finish_page(page_text: str, model: str, results: List[Optional[List[Dict]]]) -> List[Dict]:
+    """
+    Merge the per-window results of a page (None for a failed window) and
+    remember them for near-duplicate pages, unless a window failed.
+    """
+    highlights = _merge_window_highlights([r or [] for r in results])
+    if all(r is not None for r in results):
+        semantic_cache.put(model, PAGE_PROMPT_VERSION, page_text, highlights)
+    return highlights
+
+
+def _extract_window(
+    client: OpenAI, page_num: int, text: str, model: str
+) -> Optional[List[Dict]]:
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt},
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.3,  # Lower temperature for more consistent verbatim extraction
+        return _complete(
+            client,
+            _page_request_body(page_num, text, model),
+            lambda content: _parse_page_highlights(content, page_num),
+            f"Page {page_num}",
         )
 
-        content = response.choices[0].message.content
-        result = json.loads(content)
+    except orjson.JSONDecodeError as e:
+        log.error("Error parsing JSON from LLM on page %s: %s", page_num, e)
+        return None
+    except Exception as e:
+        log.error("Error calling LLM on page %s: %s", page_num, e)
+        return None
 
-        # Validate and return highlights
-        highlights = result.get("highlights", [])
-        # Ensure all highlights have the correct page number
-        for h in highlights:
-            h["page"] = page_num
 
-        return highlights
+async def extract_highlights_from_page_async(
+    async_client: AsyncOpenAI, page_num: int, page_text: str, model: str = "gpt-4o-mini"
+) -> List[Dict]:
+    """
+    Async version of extract_highlights_from_page.
 
-    except json.JSONDecodeError as e:
-        print(f"Error parsing JSON from LLM on page {page_num}: {e}")
-        return []
+    Args:
+        async_client: AsyncOpenAI client instance
+        page_num: Page number (1-based)
+        page_text: Text content of the page
+        model: Model to use (default: gpt-4o-mini)
+
+    Returns:
+        List of highlight dicts with "page", "quote", "label" keys
+    """
+    # The cache lookup (SQLite plus a fuzzy scan) would stall the event loop
+    cached = await asyncio.to_thread(_similar_page_highlights, page_num, page_text, model)
+    if cached is not None:
+        return cached
+
+    windows = _page_windows(page_num, page_text, model)
+    results = await asyncio.gather(
+        *[_extract_window_async(async_client, page_num, window, model) for window in windows]
+    )
+    return await asyncio.to_thread(_finish_page, page_text, model, results)
+
+
+async def _extract_window_async(
+    async_client: AsyncOpenAI, page_num: int, text: str, model: str
+) -> Optional[List[Dict]]:
+    try:
+        return await _complete_async(
+            async_client,
+            _page_request_body(page_num, text, model),
+            lambda content: _parse_page_highlights(content, page_num),
+            f"Page {page_num}",
+        )
+
+    except orjson.JSONDecodeError as e:
+        log.error("Error parsing JSON from LLM on page %s: %s", page_num, e)
+        return None
     except Exception as e:
-        print(f"Error calling LLM on page {page_num}: {e}")
-        return []
+        log.error("Error calling LLM on page %s: %s", page_num, e)
+        return None
+
+
+async def extract_highlights_from_pdf_async(
+    async_client: AsyncOpenAI,
+    pages: List[Dict[str, any]],
+    model: str = "gpt-4o-mini",
+    max_highlights_per_page: int = 7,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[Dict]:
+    """
+    Extract highlights from all pages of a PDF, sending pages to the LLM
+    concurrently (at most `concurrency` at a time).
+
+    Args:
+        async_client: AsyncOpenAI client instance
+        pages: List of page dicts with "page" and "text" keys
+        model: Model to use
+        max_highlights_per_page: Maximum highlights to extract per page
+        concurrency: Max number of concurrent LLM requests
+
+    Returns:
+        Combined list of all highlights from all pages, in page order
+    """
+    # Repeated pages (boilerplate, covers, references) are sent once and share results
+    to_process = []
+    first_page_for = {}
+    duplicate_of = {}
+    for page_info in pages:
+        page_text = page_info["text"].strip()
+        if not page_text:
+            log.info("Skipping empty page %s", page_info["page"])
+            continue
+        text_key = hashlib.md5(page_text.encode("utf-8")).hexdigest()
+        if text_key in first_page_for:
+            duplicate_of[page_info["page"]] = first_page_for[text_key]
+            continue
+        first_page_for[text_key] = page_info["page"]
+        to_process.append(page_info)
+
+    # Near-identical pages (e.g. differing only in a running header) are grouped
+    # the same way, as none of them is in the semantic cache until after the gather
+    similar_to = {}
+    groups = semantic_cache.group_similar([p["text"] for p in to_process])
+    for page_info, representative in zip(to_process, groups):
+        if representative is not None:
+            similar_to[page_info["page"]] = to_process[representative]
+    to_request = [p for p in to_process if p["page"] not in similar_to]
+
+    log.info(
+        "Processing %d pages (%d duplicates and %d near-duplicates skipped, "
+        "up to %d concurrently)...",
+        len(to_request),
+        len(duplicate_of),
+        len(similar_to),
+        concurrency,
+    )
+
+    def extract(p):
+        return extract_highlights_from_page_async(async_client, p["page"], p["text"], model)
+
+    results = await _gather_bounded(extract, to_request, concurrency)
+    by_page = {p["page"]: highlights for p, highlights in zip(to_request, results)}
+
+    # A near-duplicate whose differing text held all of its representative's
+    # quotes is sent on its own after all
+    leftovers = []
+    for page_info in to_process:
+        representative = similar_to.get(page_info["page"])
+        if representative is None:
+            continue
+        source = by_page[representative["page"]]
+        reused = semantic_cache.reuse(source, page_info["text"])
+        if source and not reused:
+            leftovers.append(page_info)
+            continue
+        log.info(
+            "Page %s: reusing highlights from near-identical page %s",
+            page_info["page"],
+            representative["page"],
+        )
+        by_page[page_info["page"]] = [dict(h, page=page_info["page"]) for h in reused]
+    if leftovers:
+        results = await _gather_bounded(extract, leftovers, concurrency)
+        by_page.update((p["page"], highlights) for p, highlights in zip(leftovers, results))
+
+    all_highlights = []
+    for page_info in pages:
+        page_num = page_info["page"]
+        if page_num in duplicate_of:
+            highlights = [
+                dict(h, page=page_num) for h in by_page[duplicate_of[page_num]]
+            ]
+        elif page_num in by_page:
+            highlights = by_page[page_num]
+        else:
+            continue
+
+        # Limit highlights per page
+        if len(highlights) > max_highlights_per_page:
+            highlights = highlights[:max_highlights_per_page]
+
+        all_highlights.extend(highlights)
+        log.info("  Found %d highlights on page %s", len(highlights), page_num)
+
+    return all_highlights
 
 
 def extract_highlights_from_pdf(
@@ -124,49 +640,403 @@ def extract_highlights_from_pdf(
     pages: List[Dict[str, any]],
     model: str = "gpt-4o-mini",
     max_highlights_per_page: int = 7,
+    concurrency: int = DEFAULT_CONCURRENCY,
 ) -> List[Dict]:
     """
     Extract highlights from all pages of a PDF.
+    Sync wrapper around extract_highlights_from_pdf_async.
 
     Args:
         client: OpenAI client instance
         pages: List of page dicts with "page" and "text" keys
         model: Model to use
         max_highlights_per_page: Maximum highlights to extract per page
+        concurrency: Max number of concurrent LLM requests
+
+    Returns:
+        Combined list of all highlights from all pages, in page order
+    """
+
+    async def _run() -> List[Dict]:
+        async with _async_client_for(client) as async_client:
+            return await extract_highlights_from_pdf_async(
+                async_client,
+                pages,
+                model=model,
+                max_highlights_per_page=max_highlights_per_page,
+                concurrency=concurrency,
+            )
+
+    return asyncio.run(_run())
+
+
+def _pack_pages(
+    pages: List[Dict[str, any]], model: str, target_tokens: int
+) -> List[List[Dict[str, any]]]:
+    """
+    Greedily group consecutive non-empty pages so each group's text stays
+    under target_tokens. A page larger than the target gets a group of its own.
+    """
+    enc = _encoding_or_none(model)
+    groups = []
+    current = []
+    current_tokens = 0
+    for page_info in pages:
+        if not page_info["text"].strip():
+            continue
+        if enc is None:
+            tokens = len(page_info["text"]) // CHARS_PER_TOKEN + 1
+        else:
+            tokens = len(enc.encode(page_info["text"]))
+        if current and current_tokens + tokens > target_tokens:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(page_info)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def _multipage_request_body(group: List[Dict[str, any]], model: str) -> Dict:
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": MULTIPAGE_RULES_MESSAGE},
+            {"role": "user", "content": _build_full_doc_text(group)},
+        ],
+        "response_format": HIGHLIGHTS_RESPONSE_FORMAT,
+        "temperature": 0.3,
+    }
+
+
+async def _extract_page_group_async(
+    async_client: AsyncOpenAI, group: List[Dict[str, any]], model: str
+) -> List[Dict]:
+    # A lone page goes through the per-page path (token windows, shared cache)
+    if len(group) == 1:
+        return await extract_highlights_from_page_async(
+            async_client, group[0]["page"], group[0]["text"], model
+        )
+
+    first_page, last_page = group[0]["page"], group[-1]["page"]
+    try:
+        highlights = await _complete_async(
+            async_client,
+            _multipage_request_body(group, model),
+            _parse_highlights,
+            f"Pages {first_page}-{last_page}",
+            timeout=DOCUMENT_REQUEST_TIMEOUT,
+        )
+    except orjson.JSONDecodeError as e:
+        log.error("Error parsing JSON from LLM on pages %s-%s: %s", first_page, last_page, e)
+        return []
+    except Exception as e:
+        log.error("Error calling LLM on pages %s-%s: %s", first_page, last_page, e)
+        return []
+
+    # Drop anything attributed to a page that wasn't in this request
+    page_nums = {p["page"] for p in group}
+    return [h for h in highlights if h["page"] in page_nums]
+
+
+async def extract_highlights_multipage_async(
+    async_client: AsyncOpenAI,
+    pages: List[Dict[str, any]],
+    model: str = "gpt-4o-mini",
+    target_tokens_per_call: int = DEFAULT_MULTIPAGE_TOKENS,
+    max_highlights_per_page: int = 7,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[Dict]:
+    """
+    Extract highlights with several consecutive pages packed into each request,
+    so a document takes a handful of calls instead of one per page.
+
+    Args:
+        async_client: AsyncOpenAI client instance
+        pages: List of page dicts with "page" and "text" keys
+        model: Model to use
+        target_tokens_per_call: Page text token budget per request
+        max_highlights_per_page: Maximum highlights to keep per page
+        concurrency: Max number of concurrent LLM requests
 
     Returns:
-        Combined list of all highlights from all pages
+        Combined list of all highlights from all pages, in page order
     """
+    groups = _pack_pages(pages, model, target_tokens_per_call)
+    log.info(
+        "Processing %d pages in %d requests (up to %d concurrently)...",
+        sum(len(g) for g in groups),
+        len(groups),
+        concurrency,
+    )
+    results = await _gather_bounded(
+        lambda group: _extract_page_group_async(async_client, group, model),
+        groups,
+        concurrency,
+    )
+
+    by_page = {}
+    for highlights in results:
+        for h in highlights:
+            by_page.setdefault(h["page"], []).append(h)
+
     all_highlights = []
+    for page_info in pages:
+        highlights = by_page.get(page_info["page"], [])[:max_highlights_per_page]
+        if highlights:
+            all_highlights.extend(highlights)
+            log.info("  Found %d highlights on page %s", len(highlights), page_info["page"])
+    return all_highlights
 
+
+def extract_highlights_multipage(
+    client: OpenAI,
+    pages: List[Dict[str, any]],
+    model: str = "gpt-4o-mini",
+    target_tokens_per_call: int = DEFAULT_MULTIPAGE_TOKENS,
+    max_highlights_per_page: int = 7,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> List[Dict]:
+    """
+    Sync wrapper around extract_highlights_multipage_async.
+    """
+
+    async def _run() -> List[Dict]:
+        async with _async_client_for(client) as async_client:
+            return await extract_highlights_multipage_async(
+                async_client,
+                pages,
+                model=model,
+                target_tokens_per_call=target_tokens_per_call,
+                max_highlights_per_page=max_highlights_per_page,
+                concurrency=concurrency,
+            )
+
+    return asyncio.run(_run())
+
+
+def submit_highlights_batch(
+    client: OpenAI,
+    pages: List[Dict[str, any]],
+    model: str = "gpt-4o-mini",
+) -> Optional[str]:
+    """
+    Queue per-page highlight extraction as an OpenAI Batch API job
+    (half the token cost, results within 24h, usually minutes).
+
+    Args:
+        client: OpenAI client instance
+        pages: List of page dicts with "page" and "text" keys
+        model: Model to use
+
+    Returns:
+        Batch id to pass to retrieve_highlights_batch, or None if nothing was queued
+    """
+    lines = []
     for page_info in pages:
         page_num = page_info["page"]
         page_text = page_info["text"]
-
         if not page_text.strip():
-            print(f"Skipping empty page {page_num}")
             continue
+        windows = _page_windows(page_num, page_text, model)
+        for window_num, window in enumerate(windows):
+            lines.append(
+                orjson.dumps(
+                    {
+                        "custom_id": f"page-{page_num}-{window_num}",
+                        "method": "POST",
+                        "url": BATCH_ENDPOINT,
+                        "body": _page_request_body(page_num, window, model),
+                    }
+                )
+            )
+
+    if not lines:
+        log.warning("No non-empty pages to queue for batch extraction")
+        return None
 
-        print(f"Processing page {page_num}...")
-        highlights = extract_highlights_from_page(client, page_num, page_text, model)
+    try:
+        batch_input = client.files.create(
+            file=("highlights_batch.jsonl", b"\n".join(lines)),
+            purpose="batch",
+            timeout=DOCUMENT_REQUEST_TIMEOUT,
+        )
+        batch = client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+    except Exception as e:
+        log.error("Error submitting highlights batch: %s", e)
+        return None
 
-        # Limit highlights per page
-        if len(highlights) > max_highlights_per_page:
-            highlights = highlights[:max_highlights_per_page]
+    log.info("Queued batch %s with %d pages", batch.id, len(lines))
+    return batch.id
+
+
+def _is_transient_error(e: Exception) -> bool:
+    """
+    Whether an API error is worth retrying later (network trouble, rate
+    limiting, server errors).
+    """
+    if isinstance(e, (APIConnectionError, APITimeoutError, RateLimitError)):
+        return True
+    return isinstance(e, APIStatusError) and e.status_code >= 500
 
-        all_highlights.extend(highlights)
-        print(f"  Found {len(highlights)} highlights on page {page_num}")
 
+def retrieve_highlights_batch(
+    client: OpenAI,
+    batch_id: str,
+    max_highlights_per_page: int = 7,
+) -> Optional[List[Dict]]:
+    """
+    Fetch the results of a batch queued by submit_highlights_batch.
+
+    Returns:
+        None while the batch is still running (or a transient API error kept its
+        status from being fetched this time), otherwise the combined list of
+        highlights in page order (empty if the batch failed, expired or can't
+        be retrieved)
+    """
+    # Transient API errors report "not ready yet" so polling tries again;
+    # anything else (unknown batch, bad key, ...) won't fix itself
+    try:
+        batch = client.batches.retrieve(batch_id)
+    except Exception as e:
+        log.error("Error checking batch %s: %s", batch_id, e)
+        return None if _is_transient_error(e) else []
+    if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+        return None
+    if batch.status != "completed":
+        log.error("Batch %s ended with status %s", batch_id, batch.status)
+        return []
+    if not batch.output_file_id:
+        log.error("Batch %s completed without output", batch_id)
+        return []
+
+    try:
+        output = client.files.content(batch.output_file_id).content
+    except Exception as e:
+        log.error("Error downloading results of batch %s: %s", batch_id, e)
+        return None if _is_transient_error(e) else []
+    results = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        # custom_id is "page-{page_num}-{window_num}"
+        _, page_num, window_num = item["custom_id"].split("-")
+        page_num, window_num = int(page_num), int(window_num)
+        response = item.get("response") or {}
+        if item.get("error") or response.get("status_code") != 200:
+            log.error("Error in batch response for page %s: %s", page_num, item.get("error"))
+            continue
+        try:
+            content = response["body"]["choices"][0]["message"]["content"]
+            highlights = _parse_page_highlights(content, page_num)
+        except (KeyError, IndexError, orjson.JSONDecodeError) as e:
+            log.error("Error parsing batch response for page %s: %s", page_num, e)
+            continue
+        results.setdefault(page_num, []).append((window_num, highlights))
+
+    all_highlights = []
+    for page_num in sorted(results):
+        # The output file isn't guaranteed to be in request order
+        windows = sorted(results[page_num], key=lambda w: w[0])
+        merged = _merge_window_highlights([highlights for _, highlights in windows])
+        all_highlights.extend(merged[:max_highlights_per_page])
     return all_highlights
 
 
+def extract_highlights_batch(
+    client: OpenAI,
+    pages: List[Dict[str, any]],
+    model: str = "gpt-4o-mini",
+    max_highlights_per_page: int = 7,
+    poll_interval: float = 30.0,
+    max_wait: float = BATCH_MAX_WAIT,
+) -> List[Dict]:
+    """
+    Extract highlights from all pages via the Batch API, blocking until the job
+    finishes or max_wait seconds have passed.
+    """
+    batch_id = submit_highlights_batch(client, pages, model=model)
+    if not batch_id:
+        return []
+
+    deadline = time.monotonic() + max_wait
+    while True:
+        highlights = retrieve_highlights_batch(
+            client, batch_id, max_highlights_per_page=max_highlights_per_page
+        )
+        if highlights is not None:
+            return highlights
+        if time.monotonic() >= deadline:
+            log.error("Gave up waiting for batch %s after %.0fs", batch_id, max_wait)
+            return []
+        log.info("Batch %s still running, checking again in %.0fs...", batch_id, poll_interval)
+        time.sleep(poll_interval)
+
+
+_PAGE_FOOTER = "\n\n"
+
+
+def _page_header(page_num: int) -> str:
+    return f"<<<PAGE {page_num}>>>\n"
+
+
+def _page_block(page_num: int, page_text: str) -> str:
+    """
+    One page as it appears in document-level prompts.
+    """
+    return "".join((_page_header(page_num), page_text, _PAGE_FOOTER))
+
+
 def _build_full_doc_text(pages: List[Dict[str, any]]) -> str:
-    parts = []
-    for page_info in pages:
-        page_num = page_info["page"]
-        page_text = page_info["text"] or ""
-        parts.append(f"<<<PAGE {page_num}>>>\n{page_text}\n")
-    return "\n".join(parts)
+    return _join_page_texts(tuple((p["page"], p["text"] or "") for p in pages))
+
+
+def _full_doc_text_len(pages: List[Dict[str, any]]) -> int:
+    """
+    Length of _build_full_doc_text(pages), computed without building the string.
+    """
+    return sum(
+        len(_page_header(p["page"])) + len(p["text"] or "") + len(_PAGE_FOOTER) for p in pages
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _join_page_texts(page_texts: Tuple[Tuple[int, str], ...]) -> str:
+    # Memoized: summary and highlight calls on the same document share one build
+    return "".join([_page_block(page_num, page_text) for page_num, page_text in page_texts])
+
+
+def _document_messages(doc_text: str, task_prompt: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": DOCUMENT_SYSTEM_PROMPT_TEMPLATE.format(doc_text=doc_text)},
+        {"role": "user", "content": task_prompt},
+    ]
+
+
+def _log_usage(response, what: str) -> None:
+    usage = getattr(response, "usage", None)
+    if not usage:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    log.info("%s: %s prompt tokens (%s cached)", what, usage.prompt_tokens, cached)
+
+
+def _summary_request_body(doc_text: str, model: str) -> Dict:
+    return {
+        "model": model,
+        "messages": _document_messages(doc_text, SUMMARY_USER_PROMPT),
+        "response_format": {"type": "json_schema", "json_schema": SUMMARY_SCHEMA},
+        "temperature": 0.3,
+    }
 
 
 def _summarize_chunk(
@@ -174,18 +1044,27 @@ def _summarize_chunk(
     doc_text: str,
     model: str,
 ) -> Dict:
-    prompt = SUMMARY_USER_PROMPT_TEMPLATE.format(doc_text=doc_text)
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
-            {"role": "user", "content": prompt},
-        ],
-        response_format={"type": "json_object"},
-        temperature=0.3,
+    return _complete(
+        client,
+        _summary_request_body(doc_text, model),
+        orjson.loads,
+        "Summary",
+        timeout=DOCUMENT_REQUEST_TIMEOUT,
+    )
+
+
+async def _summarize_chunk_async(
+    async_client: AsyncOpenAI,
+    doc_text: str,
+    model: str,
+) -> Dict:
+    return await _complete_async(
+        async_client,
+        _summary_request_body(doc_text, model),
+        orjson.loads,
+        "Summary",
+        timeout=DOCUMENT_REQUEST_TIMEOUT,
     )
-    content = response.choices[0].message.content
-    return json.loads(content)
 
 
 def summarize_document(
@@ -193,42 +1072,52 @@ def summarize_document(
     pages: List[Dict[str, any]],
     model: str = "gpt-4o-mini",
     max_context_chars: int = 120000,
+    concurrency: int = DEFAULT_CONCURRENCY,
 ) -> Dict:
     """
-    Summarize the full document. If too large, summarize chunks then summarize the summaries.
+    Summarize the full document. If too large, summarize chunks (concurrently)
+    then summarize the summaries.
     Returns dict with keys: summary, key_points, open_questions.
     """
-    doc_text = _build_full_doc_text(pages)
-    if len(doc_text) <= max_context_chars:
+    if _full_doc_text_len(pages) <= max_context_chars:
         try:
-            return _summarize_chunk(client, doc_text, model)
+            return _summarize_chunk(client, _build_full_doc_text(pages), model)
         except Exception as e:
-            print(f"Error summarizing full document: {e}")
+            log.error("Error summarizing full document: %s", e)
             return {}
 
-    # Chunk by pages to stay under max_context_chars
+    # Chunk by pages to stay under max_context_chars. Page blocks are built once
+    # and each chunk is a single join over a slice of them.
+    blocks = [_page_block(p["page"], p["text"] or "") for p in pages]
     chunks = []
-    current = []
+    start = 0
     current_len = 0
-    for page_info in pages:
-        block = f"<<<PAGE {page_info['page']}>>>\n{page_info['text']}\n"
-        if current_len + len(block) > max_context_chars and current:
-            chunks.append("\n".join(current))
-            current = [block]
-            current_len = len(block)
-        else:
-            current.append(block)
-            current_len += len(block)
-    if current:
-        chunks.append("\n".join(current))
-
-    summaries = []
-    for i, chunk in enumerate(chunks, start=1):
+    for i, block in enumerate(blocks):
+        if current_len + len(block) > max_context_chars and i > start:
+            chunks.append("".join(blocks[start:i]))
+            start = i
+            current_len = 0
+        current_len += len(block)
+    if start < len(blocks):
+        chunks.append("".join(blocks[start:]))
+
+    async def _summarize_indexed(async_client: AsyncOpenAI, i: int) -> Optional[Dict]:
         try:
-            print(f"Summarizing chunk {i}/{len(chunks)}...")
-            summaries.append(_summarize_chunk(client, chunk, model))
+            log.info("Summarizing chunk %d/%d...", i + 1, len(chunks))
+            return await _summarize_chunk_async(async_client, chunks[i], model)
         except Exception as e:
-            print(f"Error summarizing chunk {i}: {e}")
+            log.error("Error summarizing chunk %d: %s", i + 1, e)
+            return None
+
+    async def _run() -> List[Optional[Dict]]:
+        async with _async_client_for(client) as async_client:
+            return await _gather_bounded(
+                lambda i: _summarize_indexed(async_client, i),
+                list(range(len(chunks))),
+                concurrency,
+            )
+
+    summaries = [s for s in asyncio.run(_run()) if s is not None]
 
     if not summaries:
         return {}
@@ -245,34 +1134,55 @@ def summarize_document(
     try:
         return _summarize_chunk(client, combined, model)
     except Exception as e:
-        print(f"Error summarizing combined chunks: {e}")
+        log.error("Error summarizing combined chunks: %s", e)
         return summaries[0] if summaries else {}
 
 
+def _collect_stream(stream, on_text: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Accumulate a streamed chat completion, calling on_text with the text so far.
+    """
+    parts = []
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            if on_text:
+                on_text("".join(parts))
+    return "".join(parts)
+
+
 def explain_page(
     client: OpenAI,
     page_num: int,
     page_text: str,
     model: str = "gpt-4o-mini",
+    on_text: Optional[Callable[[str], None]] = None,
 ) -> str:
     """
     Explain a single page for a reader.
+    If on_text is given the response is streamed and on_text is called with the
+    partial explanation as it arrives.
     """
-    prompt = PAGE_EXPLAIN_USER_PROMPT_TEMPLATE.format(
-        page_num=page_num, page_text=page_text
-    )
+    page_message = PAGE_EXPLAIN_PAGE_TEMPLATE.format(page_num=page_num, page_text=page_text)
     try:
         response = client.chat.completions.create(
             model=model,
             messages=[
                 {"role": "system", "content": PAGE_EXPLAIN_SYSTEM_PROMPT},
-                {"role": "user", "content": prompt},
+                {"role": "user", "content": PAGE_EXPLAIN_RULES_MESSAGE},
+                {"role": "user", "content": page_message},
             ],
             temperature=0.3,
+            stream=on_text is not None,
         )
+        if on_text is not None:
+            return _collect_stream(response, on_text).strip()
         return response.choices[0].message.content.strip()
     except Exception as e:
-        print(f"Error explaining page {page_num}: {e}")
+        log.error("Error explaining page %s: %s", page_num, e)
         return ""
 
 def extract_highlights_from_pdf_fullcontext(
@@ -286,12 +1196,13 @@ def extract_highlights_from_pdf_fullcontext(
     Extract highlights from the full document context in a single prompt.
     Falls back to per-page extraction if the document is too large.
     """
-    doc_text = _build_full_doc_text(pages)
-    if len(doc_text) > max_context_chars:
-        print(
-            f"Full document text is {len(doc_text)} chars; "
-            f"exceeds max_context_chars={max_context_chars}. "
-            "Falling back to per-page extraction."
+    doc_len = _full_doc_text_len(pages)
+    if doc_len > max_context_chars:
+        log.info(
+            "Full document text is %d chars; exceeds max_context_chars=%d. "
+            "Falling back to per-page extraction.",
+            doc_len,
+            max_context_chars,
         )
         return extract_highlights_from_pdf(
             client,
@@ -300,32 +1211,81 @@ def extract_highlights_from_pdf_fullcontext(
             max_highlights_per_page=max_highlights_per_page,
         )
 
-    prompt = FULL_CONTEXT_USER_PROMPT_TEMPLATE.format(doc_text=doc_text)
-
+    doc_text = _build_full_doc_text(pages)
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": FULL_CONTEXT_SYSTEM_PROMPT},
-                {"role": "user", "content": prompt},
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.3,
+        return _complete(
+            client,
+            {
+                "model": model,
+                "messages": _document_messages(doc_text, FULL_CONTEXT_USER_PROMPT),
+                "response_format": HIGHLIGHTS_RESPONSE_FORMAT,
+                "temperature": 0.3,
+            },
+            _parse_highlights,
+            "Full-context highlights",
+            timeout=DOCUMENT_REQUEST_TIMEOUT,
         )
 
-        content = response.choices[0].message.content
-        result = json.loads(content)
-        highlights = result.get("highlights", [])
-        return highlights
-
-    except json.JSONDecodeError as e:
-        print(f"Error parsing JSON from full-context LLM: {e}")
+    except orjson.JSONDecodeError as e:
+        log.error("Error parsing JSON from full-context LLM: %s", e)
         return []
     except Exception as e:
-        print(f"Error calling full-context LLM: {e}")
+        log.error("Error calling full-context LLM: %s", e)
         return []
 
 
+# Priority of each label when capping highlights locally
+LABEL_WEIGHTS = {
+    "Decision": 3.0,
+    "Risk": 3.0,
+    "Numbers": 2.0,
+    "Constraint": 2.0,
+    "Problem": 2.0,
+    "Insight": 1.0,
+}
+DEFAULT_LABEL_WEIGHT = 0.5
+
+
+def cap_total_highlights_local(highlights: List[Dict], max_total: int = 25) -> List[Dict]:
+    """
+    Select the top N highlights without an LLM call: rank each page's
+    highlights by label priority (then quote length) and take them round-robin
+    across pages, so every page keeps its best highlight before any page gets
+    a second one.
+
+    Args:
+        highlights: List of all highlights
+        max_total: Maximum total highlights to keep
+
+    Returns:
+        Selected highlights, in their original order
+    """
+    if len(highlights) <= max_total:
+        return highlights
+
+    def _score(i: int) -> Tuple[float, int]:
+        h = highlights[i]
+        return LABEL_WEIGHTS.get(h.get("label"), DEFAULT_LABEL_WEIGHT), len(h["quote"])
+
+    by_page = {}
+    for i, h in enumerate(highlights):
+        by_page.setdefault(h["page"], []).append(i)
+    ranked = [sorted(indices, key=_score, reverse=True) for indices in by_page.values()]
+
+    selected = []
+    for round_num in range(max(len(indices) for indices in ranked)):
+        # Within a round, the strongest picks go first in case the cap cuts it short
+        picks = sorted(
+            (indices[round_num] for indices in ranked if round_num < len(indices)),
+            key=_score,
+            reverse=True,
+        )
+        selected.extend(picks[: max_total - len(selected)])
+        if len(selected) >= max_total:
+            break
+    return [highlights[i] for i in sorted(selected)]
+
+
 def cap_total_highlights(
     client: OpenAI,
     highlights: List[Dict],
@@ -347,46 +1307,49 @@ def cap_total_highlights(
     if len(highlights) <= max_total:
         return highlights
 
-    # Create a summary of all highlights for the LLM to rank
+    # Create a numbered summary of all highlights for the LLM to rank
     highlights_summary = "\n".join(
         [
-            f"Page {h['page']} [{h.get('label', 'N/A')}]: {h['quote'][:100]}..."
-            for h in highlights
+            f"{i}. Page {h['page']} [{h.get('label', 'N/A')}]: {h['quote'][:100]}..."
+            for i, h in enumerate(highlights)
         ]
     )
 
-    prompt = f"""From the following {len(highlights)} highlights, select the top {max_total} most important ones for case understanding.
+    prompt = f"""From the following {len(highlights)} highlights, select the top {max_total} most important ones for case understanding, by number.
 
 Consider:
 - Importance for understanding the case
 - Diversity across pages
 - Key decisions, constraints, numbers, risks
 
-Return JSON with the selected highlights in the same format:
-{{"highlights":[{{"page":<page>, "quote":"...", "label":"..."}}]}}
-
 All highlights:
 {highlights_summary}
 """
 
+    def _parse(content: str) -> List[Dict]:
+        indices = sorted({i for i in orjson.loads(content)["selected"] if 0 <= i < len(highlights)})
+        return [highlights[i] for i in indices[:max_total]]
+
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You select the most important highlights from a list.",
-                },
-                {"role": "user", "content": prompt},
-            ],
-            response_format={"type": "json_object"},
-            temperature=0.3,
+        selected = _complete(
+            client,
+            {
+                "model": model,
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": "You select the most important highlights from a list.",
+                    },
+                    {"role": "user", "content": prompt},
+                ],
+                "response_format": {"type": "json_schema", "json_schema": SELECTION_SCHEMA},
+                "temperature": 0.3,
+            },
+            _parse,
+            "Highlight selection",
         )
-
-        content = response.choices[0].message.content
-        result = json.loads(content)
-        return result.get("highlights", highlights[:max_total])
+        return selected or highlights[:max_total]
 
     except Exception as e:
-        print(f"Error capping highlights, using first {max_total}: {e}")
+        log.error("Error capping highlights, using first %d: %s", max_total, e)
         return highlights[:max_total]
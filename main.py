@@ -3,19 +3,134 @@
 Main entry point for the PDF highlighter.
 """
 import argparse
+import asyncio
+import hashlib
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from dotenv import load_dotenv
+# PyMuPDF, openai, tiktoken and rapidfuzz are slow to import, so modules that
+# pull them in are imported where they are first needed: --help stays instant
+# and --skip-llm never loads the LLM stack.
 
-load_dotenv()  # load OPENAI_API_KEY from .env if present
 
-from openai import OpenAI
-from pdf_highlighter import extract_text_per_page, highlight_pdf
-from llm_extractor import (
-    extract_highlights_from_pdf,
-    extract_highlights_from_pdf_fullcontext,
-    cap_total_highlights,
-)
+async def extract_pages_async(api_key: str, pages, model: str, max_per_page: int, concurrency: int):
+    from llm_extractor import extract_highlights_from_pdf_async, make_async_client
+
+    async with make_async_client(api_key) as async_client:
+        return await extract_highlights_from_pdf_async(
+            async_client,
+            pages,
+            model=model,
+            max_highlights_per_page=max_per_page,
+            concurrency=concurrency,
+        )
+
+
+# Loggers of this project's modules, shown at INFO on the console
+PROJECT_LOGGERS = ("llm_extractor", "llm_cache", "pdf_highlighter", "semantic_cache")
+
+# Pages / page results buffered between pipeline stages
+PIPELINE_QUEUE_SIZE = 8
+
+
+async def highlight_pipeline_async(
+    api_key: str,
+    input_pdf: str,
+    output_pdf: str,
+    model: str,
+    max_per_page: int,
+    concurrency: int,
+) -> int:
+    """
+    Extract text, query the LLM and annotate as one pipeline, so PDF work on
+    earlier/later pages overlaps with waiting on the API:
+
+        page text -> [queue] -> LLM workers -> [queue] -> annotator
+
+    PyMuPDF is not thread-safe, so extraction and annotation share a single
+    dedicated thread (and one open document); only the LLM stage is concurrent.
+    Returns the number of highlights placed.
+    """
+    from llm_extractor import extract_highlights_from_page_async, make_async_client
+    from pdf_highlighter import annotate_page, open_pdf, page_text, save_pdf
+
+    loop = asyncio.get_running_loop()
+    fitz_thread = ThreadPoolExecutor(max_workers=1)
+
+    def on_doc(func, *args):
+        return loop.run_in_executor(fitz_thread, func, *args)
+
+    doc = await on_doc(open_pdf, input_pdf, output_pdf)
+    page_count = await on_doc(lambda: doc.page_count)
+    print(f"Found {page_count} pages")
+
+    pages = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    results = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # Repeated pages (boilerplate, covers) are sent once and share results
+    first_result_for = {}
+
+    async def extract_pages():
+        for page_num in range(1, page_count + 1):
+            text = await on_doc(page_text, doc, page_num)
+            if text.strip():
+                await pages.put((page_num, text))
+        for _ in range(concurrency):
+            await pages.put(None)
+
+    async def query_pages(async_client):
+        while (item := await pages.get()) is not None:
+            page_num, text = item
+            text_key = hashlib.md5(text.strip().encode("utf-8")).hexdigest()
+            if text_key in first_result_for:
+                highlights = [
+                    dict(h, page=page_num) for h in await first_result_for[text_key]
+                ]
+            else:
+                first_result_for[text_key] = loop.create_future()
+                highlights = await extract_highlights_from_page_async(
+                    async_client, page_num, text, model
+                )
+                first_result_for[text_key].set_result(highlights)
+            await results.put((page_num, highlights[:max_per_page]))
+
+    async def annotate_pages():
+        placed = 0
+        while (item := await results.get()) is not None:
+            page_num, highlights = item
+            if not highlights:
+                continue
+            # Keep draining the queue on failure so LLM workers never block on it
+            try:
+                placed += await on_doc(annotate_page, doc, page_num, highlights)
+            except Exception as e:
+                print(f"  Error highlighting page {page_num}: {e}")
+                continue
+            print(f"  Page {page_num}: {len(highlights)} highlights")
+        return placed
+
+    try:
+        async with make_async_client(api_key) as async_client:
+            annotator = asyncio.create_task(annotate_pages())
+            await asyncio.gather(
+                extract_pages(), *[query_pages(async_client) for _ in range(concurrency)]
+            )
+            await results.put(None)
+            placed = await annotator
+        await on_doc(save_pdf, doc, output_pdf)
+    finally:
+        if not doc.is_closed:
+            await on_doc(doc.close)
+        fitz_thread.shutdown()
+    return placed
+
+
+def positive_int(value: str) -> int:
+    # With 0 workers the pipeline queues (and a zero semaphore) would wait forever
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 
 def main():
@@ -49,18 +164,50 @@ def main():
         action="store_true",
         help="Use full-document context in a single LLM call (if size permits)"
     )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the OpenAI Batch API for per-page extraction (half cost, may take up to 24h)"
+    )
+    parser.add_argument(
+        "--multipage",
+        action="store_true",
+        help="Pack several consecutive pages into each LLM request (fewer, larger calls)"
+    )
+    parser.add_argument(
+        "--multipage-tokens",
+        type=int,
+        default=None,
+        help="Page text tokens per request with --multipage (default: 8000)"
+    )
     parser.add_argument(
         "--max-context-chars",
         type=int,
         default=120000,
         help="Max characters for full-context prompt before fallback (default: 120000)"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=positive_int,
+        default=None,
+        help="Max concurrent per-page LLM requests (default: 8)"
+    )
     parser.add_argument(
         "--max-total",
         type=int,
         default=None,
         help="Maximum total highlights across all pages (default: no limit)"
     )
+    parser.add_argument(
+        "--llm-cap",
+        action="store_true",
+        help="With --max-total, let the LLM pick the top highlights instead of ranking them locally"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the local LLM response cache (~/.cache/case_highlighter)"
+    )
     parser.add_argument(
         "--skip-llm",
         action="store_true",
@@ -73,6 +220,22 @@ def main():
     )
     
     args = parser.parse_args()
+
+    # Library modules log progress; show it on the console like the rest of the CLI
+    # output. Only this project's loggers go to INFO, so httpx/openai stay quiet.
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    for name in PROJECT_LOGGERS:
+        logging.getLogger(name).setLevel(logging.INFO)
+    if args.no_cache:
+        import llm_cache
+        import semantic_cache
+
+        llm_cache.set_enabled(False)
+        semantic_cache.set_enabled(False)
+
+    from dotenv import load_dotenv
+
+    load_dotenv()  # load OPENAI_API_KEY from .env if present
     
     # Validate input file
     if not os.path.exists(args.input_pdf):
@@ -86,6 +249,39 @@ def main():
         base, ext = os.path.splitext(args.input_pdf)
         output_pdf = f"{base}_highlighted{ext}"
     
+    api_key = None
+    if not args.skip_llm:
+        api_key = args.api_key or os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            print("Error: OpenAI API key required. Put OPENAI_API_KEY=your-key in .env or use --api-key")
+            return 1
+
+        from llm_extractor import DEFAULT_CONCURRENCY, DEFAULT_MULTIPAGE_TOKENS
+
+        if args.concurrency is None:
+            args.concurrency = DEFAULT_CONCURRENCY
+        if args.multipage_tokens is None:
+            args.multipage_tokens = DEFAULT_MULTIPAGE_TOKENS
+
+    # Default per-page mode: stream pages through extraction, LLM and annotation
+    if not (args.skip_llm or args.batch or args.multipage or args.full_context or args.max_total):
+        print(f"Extracting and highlighting {args.input_pdf} using {args.model}...")
+        placed = asyncio.run(
+            highlight_pipeline_async(
+                api_key,
+                args.input_pdf,
+                output_pdf,
+                args.model,
+                args.max_per_page,
+                args.concurrency,
+            )
+        )
+        print(f"\nTotal highlights applied: {placed}")
+        print(f"\nDone! Highlighted PDF saved to: {output_pdf}")
+        return 0
+
+    from pdf_highlighter import extract_text_per_page, highlight_pdf
+
     # Extract text from PDF
     print(f"Extracting text from PDF: {args.input_pdf}")
     pages = extract_text_per_page(args.input_pdf)
@@ -105,39 +301,61 @@ def main():
         print(f"Loaded {len(highlights)} highlights from {args.highlights_json}")
     else:
         # Use LLM to extract highlights
-        api_key = args.api_key or os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            print("Error: OpenAI API key required. Put OPENAI_API_KEY=your-key in .env or use --api-key")
-            return 1
-        
-        client = OpenAI(api_key=api_key)
+        from llm_extractor import (
+            cap_total_highlights,
+            cap_total_highlights_local,
+            extract_highlights_batch,
+            extract_highlights_from_pdf_fullcontext,
+            extract_highlights_multipage,
+            make_client,
+        )
+
+        client = make_client(api_key)
         
         print(f"Extracting highlights using {args.model}...")
-        if args.full_context:
-            highlights = extract_highlights_from_pdf_fullcontext(
+        if args.batch:
+            highlights = extract_highlights_batch(
                 client,
                 pages,
                 model=args.model,
-                max_context_chars=args.max_context_chars,
                 max_highlights_per_page=args.max_per_page,
             )
-        else:
-            highlights = extract_highlights_from_pdf(
+        elif args.multipage:
+            highlights = extract_highlights_multipage(
+                client,
+                pages,
+                model=args.model,
+                target_tokens_per_call=args.multipage_tokens,
+                max_highlights_per_page=args.max_per_page,
+                concurrency=args.concurrency,
+            )
+        elif args.full_context:
+            highlights = extract_highlights_from_pdf_fullcontext(
                 client,
                 pages,
                 model=args.model,
-                max_highlights_per_page=args.max_per_page
+                max_context_chars=args.max_context_chars,
+                max_highlights_per_page=args.max_per_page,
+            )
+        else:
+            highlights = asyncio.run(
+                extract_pages_async(
+                    api_key, pages, args.model, args.max_per_page, args.concurrency
+                )
             )
         
         # Optionally cap total highlights
         if args.max_total and len(highlights) > args.max_total:
             print(f"Capping highlights to top {args.max_total}...")
-            highlights = cap_total_highlights(
-                client,
-                highlights,
-                max_total=args.max_total,
-                model=args.model
-            )
+            if args.llm_cap:
+                highlights = cap_total_highlights(
+                    client,
+                    highlights,
+                    max_total=args.max_total,
+                    model=args.model
+                )
+            else:
+                highlights = cap_total_highlights_local(highlights, max_total=args.max_total)
     
     print(f"\nTotal highlights to apply: {len(highlights)}")
     
@@ -150,4 +368,4 @@ def main():
 
 
 if __name__ == "__main__":
-    exit(main())
+    raise SystemExit(main())
@@ -1,63 +1,174 @@
 """
 Core PDF highlighting module with robust phrase matching.
 """
+import functools
+import logging
+import os
 import re
-from typing import List, Dict, Optional
+import shutil
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional, Tuple
 import fitz  # PyMuPDF
-from rapidfuzz import fuzz, process
 
+log = logging.getLogger(__name__)
 
+
+# Below this many pages, spinning up worker processes costs more than it saves
+PARALLEL_MIN_PAGES = 8
+
+# Minimum rapidfuzz partial_ratio for the fuzzy line fallback (tunable)
+FUZZY_THRESHOLD = 85
+
+
+_HYPHEN_BREAK = re.compile(r"-\s*\n\s*")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=8192)
 def normalize(s: str) -> str:
     """
     Normalize text for matching: remove soft hyphens, line-break hyphens, collapse whitespace.
+    Memoized: wrapped lines repeat across pages and fuzzy matching re-normalizes them.
     """
     s = s.replace("\u00ad", "")  # soft hyphen
-    s = re.sub(r"-\s*\n\s*", "", s)  # remove hyphenation across line breaks
-    s = re.sub(r"\s+", " ", s)
+    s = _HYPHEN_BREAK.sub("", s)  # remove hyphenation across line breaks
+    s = _WHITESPACE.sub(" ", s)
     return s.strip()
 
 
-def find_rects_for_quote(page: fitz.Page, quote: str) -> List[fitz.Rect]:
+def _page_words(page: fitz.Page) -> Tuple[List[str], List[List[Tuple]], Dict[str, List[int]]]:
     """
-    Returns a list of rectangles to highlight for the quote on this page.
-    Tries exact search first, then chunk search.
+    Tokenize a page once for quote matching, from a single get_text("words") call.
+
+    Returns (tokens, token_rects, positions): lowercased word tokens, the
+    (line, rect) pieces each token covers, and token -> indices where it occurs.
+    Words hyphenated across a line break are joined into one token.
     """
-    q = normalize(quote)
+    words = page.get_text("words")  # (x0, y0, x1, y1, word, block_no, line_no, word_no)
+    tokens = []
+    token_rects = []
+    pending_text = ""
+    pending_rects = []
+    for i, w in enumerate(words):
+        text = pending_text + w[4].replace("\u00ad", "")
+        rects = pending_rects + [((w[5], w[6]), fitz.Rect(w[:4]))]
+        line_ends = i + 1 == len(words) or words[i + 1][5:7] != w[5:7]
+        if text.endswith("-") and line_ends and i + 1 < len(words):
+            pending_text = text[:-1]
+            pending_rects = rects
+            continue
+        pending_text = ""
+        pending_rects = []
+        tokens.append(text.lower())
+        token_rects.append(rects)
 
-    # 1) exact-ish search using PyMuPDF built-in (works on raw page text layout)
-    rects = page.search_for(quote, quads=False)  # try raw quote first
-    if rects:
-        return rects
+    positions = defaultdict(list)
+    for i, token in enumerate(tokens):
+        positions[token].append(i)
+    return tokens, token_rects, positions
+
+
+def _match_tokens(page_words: Tuple, quote_tokens: List[str]) -> List[int]:
+    """
+    Start indices where quote_tokens occur consecutively in the page tokens.
+    """
+    tokens, _, positions = page_words
+    n = len(quote_tokens)
+    return [i for i in positions.get(quote_tokens[0], ()) if tokens[i:i + n] == quote_tokens]
+
+
+def _match_all_quotes(page_words: Tuple, quote_tokens: List[List[str]]) -> List[Optional[int]]:
+    """
+    First start index in the page tokens of every quote (None if absent), found
+    in a single pass over the page: quotes are indexed by their first token, so
+    each page token is only compared against the quotes that start with it.
+    """
+    by_first = defaultdict(list)
+    for qi, qt in enumerate(quote_tokens):
+        if qt:
+            by_first[qt[0]].append(qi)
+
+    tokens = page_words[0]
+    starts = [None] * len(quote_tokens)
+    remaining = sum(1 for qt in quote_tokens if qt)
+    for i, token in enumerate(tokens):
+        candidates = by_first.get(token)
+        if not candidates:
+            continue
+        for qi in candidates:
+            qt = quote_tokens[qi]
+            if starts[qi] is None and tokens[i:i + len(qt)] == qt:
+                starts[qi] = i
+                remaining -= 1
+        if not remaining:
+            break
+    return starts
+
+
+def _span_rects(page_words: Tuple, start: int, length: int) -> List[fitz.Rect]:
+    """
+    One rectangle per text line covered by tokens[start:start + length].
+    """
+    by_line = {}
+    for pieces in page_words[1][start:start + length]:
+        for line, rect in pieces:
+            if line in by_line:
+                by_line[line] |= rect
+            else:
+                by_line[line] = fitz.Rect(rect)
+    return list(by_line.values())
 
-    # try normalized quote (sometimes helps)
-    rects = page.search_for(q, quads=False)
-    if rects:
-        return rects
 
-    # 2) chunk fallback: split into word windows
-    words = q.split()
+def _find_rects_in_words(page_words: Tuple, quote: str) -> List[fitz.Rect]:
+    """
+    Token-window match of the normalized quote against the page words:
+    the whole quote first, then overlapping sub-windows of it.
+    """
+    words = normalize(quote).lower().split()
+    if not words:
+        return []
+
+    starts = _match_tokens(page_words, words)
+    if starts:
+        return _span_rects(page_words, starts[0], len(words))
+    return _find_chunk_rects(page_words, words)
+
+
+def _find_chunk_rects(page_words: Tuple, words: List[str]) -> List[fitz.Rect]:
+    """
+    Chunk fallback: rects of overlapping word windows of the quote that do
+    occur on the page.
+    """
     if len(words) < 6:
         return []
 
-    windows = []
     window_size = min(10, len(words))
     step = max(3, window_size // 2)
-
+    found = []
     for i in range(0, len(words) - window_size + 1, step):
-        chunk = " ".join(words[i:i+window_size])
-        windows.append(chunk)
+        for start in _match_tokens(page_words, words[i:i + window_size]):
+            found.extend(_span_rects(page_words, start, window_size))
+    return found
 
-    found = []
-    for chunk in windows:
-        r = page.search_for(chunk, quads=False)
-        if r:
-            found.extend(r)
 
-    # if we found at least something, return it
-    if found:
-        return found
+def find_rects_for_quote(
+    page: fitz.Page, quote: str, page_words: Optional[Tuple] = None
+) -> List[fitz.Rect]:
+    """
+    Returns a list of rectangles to highlight for the quote on this page.
+    Tries exact search first, then a token-window match over the page words.
+    Pass page_words (from _page_words) when matching several quotes on a page.
+    """
+    # 1) exact-ish search using PyMuPDF built-in (works on raw page text layout)
+    rects = page.search_for(quote, quads=False)
+    if rects:
+        return rects
 
-    return []
+    # 2) normalized token match, then sub-window chunks
+    if page_words is None:
+        page_words = _page_words(page)
+    return _find_rects_in_words(page_words, quote)
 
 
 def fuzzy_best_line(page_text: str, quote: str) -> Optional[str]:
@@ -65,20 +176,107 @@ def fuzzy_best_line(page_text: str, quote: str) -> Optional[str]:
     If exact search fails, try matching the quote to the closest line.
     Returns best matching line (string) or None.
     """
+    from rapidfuzz import fuzz, process  # only needed once exact matching fails
+
     q = normalize(quote)
-    lines = [normalize(l) for l in page_text.split("\n") if normalize(l)]
+    lines = [line for line in map(normalize, page_text.split("\n")) if line]
     if not lines:
         return None
 
     best = process.extractOne(q, lines, scorer=fuzz.partial_ratio)
-    if best and best[1] >= 85:  # threshold you can tune
+    if best and best[1] >= FUZZY_THRESHOLD:
         return best[0]
     return None
 
 
+def _find_rects_on_page(page: fitz.Page, quotes: List[str]) -> List[List[fitz.Rect]]:
+    """
+    Rectangles for each quote on one page: word tokens -> exact layout search
+    -> chunks -> fuzzy line match.
+    The page is tokenized once and all quotes are matched against it in one
+    pass; only quotes that pass miss cost a search_for each. All quotes that
+    need the fuzzy fallback are scored against the page lines in a single
+    rapidfuzz cdist call.
+    """
+    page_words = _page_words(page)
+    quote_tokens = [normalize(quote).lower().split() for quote in quotes]
+    starts = _match_all_quotes(page_words, quote_tokens)
+
+    results = []
+    for quote, words, start in zip(quotes, quote_tokens, starts):
+        if start is not None:
+            results.append(_span_rects(page_words, start, len(words)))
+        else:
+            rects = page.search_for(quote, quads=False)
+            results.append(rects or _find_chunk_rects(page_words, words))
+    missing = [i for i, rects in enumerate(results) if not rects]
+    if not missing:
+        return results
+
+    # 3) fuzzy fallback: match closest line, then search_for that line
+    from rapidfuzz import fuzz, process  # only needed once exact matching fails
+
+    lines = [line for line in map(normalize, page.get_text("text").split("\n")) if line]
+    if not lines:
+        return results
+
+    scores = process.cdist(
+        [normalize(quotes[i]) for i in missing],
+        lines,
+        scorer=fuzz.partial_ratio,
+        workers=-1,
+    )
+    best_idx = scores.argmax(axis=1)
+    for row, i in enumerate(missing):
+        if scores[row, best_idx[row]] < FUZZY_THRESHOLD:
+            continue
+        rects = page.search_for(lines[best_idx[row]], quads=False)
+        if rects:
+            log.info("Found quote via fuzzy match on page %s", page.number + 1)
+            results[i] = rects
+    return results
+
+
+def _find_rects_in_pages(pdf_path: str, groups: List) -> List[List[List[tuple]]]:
+    """
+    Worker-process entry point: open a private copy of the document and search
+    each (page_index, quotes) group. Rects are returned as plain tuples.
+    """
+    doc = fitz.open(pdf_path)
+    out = [
+        [[tuple(r) for r in rects] for rects in _find_rects_on_page(doc[page_idx], quotes)]
+        for page_idx, quotes in groups
+    ]
+    doc.close()
+    return out
+
+
+def _find_rects_grouped(
+    pdf_path: str, doc: fitz.Document, groups: List
+) -> List[List[List[fitz.Rect]]]:
+    """
+    Search all (page_index, quotes) groups, spread across worker processes when
+    many pages are involved (PyMuPDF holds the GIL, so threads would not help).
+    """
+    workers = min(8, os.cpu_count() or 1)
+    if len(groups) < PARALLEL_MIN_PAGES or workers < 2:
+        return [_find_rects_on_page(doc[page_idx], quotes) for page_idx, quotes in groups]
+
+    slices = _split_evenly(groups, workers)
+    with ProcessPoolExecutor(max_workers=len(slices)) as ex:
+        results = ex.map(_find_rects_in_pages, [pdf_path] * len(slices), slices)
+        return [
+            [[fitz.Rect(r) for r in rects] for rects in group]
+            for part in results
+            for group in part
+        ]
+
+
 def highlight_pdf(input_pdf: str, output_pdf: str, highlights: List[Dict]) -> None:
     """
     Highlights phrases in a PDF based on the provided highlights list.
+    Highlights are grouped by page; quote search runs per page (in worker
+    processes for larger documents) and annotations are then written in one pass.
     
     Args:
         input_pdf: Path to input PDF file
@@ -88,63 +286,216 @@ def highlight_pdf(input_pdf: str, output_pdf: str, highlights: List[Dict]) -> No
             - "quote": str (verbatim quote to highlight)
             - "label": str (optional, e.g., "Constraint", "Numbers", "Decision")
     """
-    doc = fitz.open(input_pdf)
+    doc = open_pdf(input_pdf, output_pdf)
 
-    for h in highlights:
+    by_page = defaultdict(list)  # 0-based page index -> indices into highlights
+    for i, h in enumerate(highlights):
         page_num = h["page"] - 1  # convert to 0-based
-        quote = h["quote"]
-
         if page_num < 0 or page_num >= doc.page_count:
-            print(f"Warning: Page {h['page']} out of range (1-{doc.page_count}), skipping quote: {quote[:50]}...")
+            log.warning(
+                "Page %s out of range (1-%d), skipping quote: %s...",
+                h["page"],
+                doc.page_count,
+                h["quote"][:50],
+            )
             continue
+        by_page[page_num].append(i)
 
-        page = doc[page_num]
+    groups = [
+        (page_num, [highlights[i]["quote"] for i in indices])
+        for page_num, indices in by_page.items()
+    ]
+    found = _find_rects_grouped(input_pdf, doc, groups)
 
-        rects = find_rects_for_quote(page, quote)
+    for (page_num, indices), group_rects in zip(by_page.items(), found):
+        _add_highlights(doc[page_num], [highlights[i] for i in indices], group_rects)
 
-        # 3) fuzzy fallback: match closest line, then search_for that line
-        if not rects:
-            page_text = page.get_text("text")
-            best_line = fuzzy_best_line(page_text, quote)
-            if best_line:
-                rects = page.search_for(best_line, quads=False)
-                if rects:
-                    print(f"Found quote via fuzzy match on page {h['page']}")
+    save_pdf(doc, output_pdf)
 
+
+def _add_highlights(
+    page: fitz.Page, highlights: List[Dict], rects_per_quote: List[List[fitz.Rect]]
+) -> int:
+    """
+    Write highlight annotations on page; returns how many quotes were placed.
+    """
+    placed = 0
+    for h, rects in zip(highlights, rects_per_quote):
         if not rects:
-            print(f"Warning: Could not find quote on page {h['page']}: {quote[:50]}...")
+            log.warning("Could not find quote on page %s: %s...", h["page"], h["quote"][:50])
             continue
 
-        for rect in rects:
-            annot = page.add_highlight_annot(rect)
-            # optional: store label/comment in the annotation
-            if "label" in h and h["label"]:
-                annot.set_info(content=h["label"])
-            annot.update()
+        # One annotation per quote covering all its rects (lines), so the label
+        # is set and the appearance stream built once
+        annot = page.add_highlight_annot([rect.quad for rect in rects])
+        # optional: store label/comment in the annotation
+        if "label" in h and h["label"]:
+            annot.set_info(content=h["label"])
+        annot.update()
+        placed += 1
+    return placed
+
+
+def _same_file(a: str, b: str) -> bool:
+    return os.path.normcase(os.path.abspath(a)) == os.path.normcase(os.path.abspath(b))
+
+
+def open_pdf(input_pdf: str, output_pdf: Optional[str] = None) -> fitz.Document:
+    """
+    Open a PDF for use with page_text / annotate_page / save_pdf.
+    With output_pdf, the input is copied there first and the copy is opened,
+    so save_pdf only has to append the new annotations to it.
+    A document must only be used from one thread at a time.
+    """
+    if output_pdf and not _same_file(input_pdf, output_pdf):
+        shutil.copyfile(input_pdf, output_pdf)
+        return fitz.open(output_pdf)
+    return fitz.open(input_pdf)
+
+
+def page_text(doc: fitz.Document, page_num: int) -> str:
+    """
+    Text of one page (1-based page_num) of an open document.
+    """
+    return doc[page_num - 1].get_text("text")
+
+
+def annotate_page(doc: fitz.Document, page_num: int, highlights: List[Dict]) -> int:
+    """
+    Find and highlight the quotes for one page (1-based page_num) of an open
+    document. Returns how many quotes were placed.
+    """
+    page = doc[page_num - 1]
+    return _add_highlights(
+        page, highlights, _find_rects_on_page(page, [h["quote"] for h in highlights])
+    )
+
+
+def save_pdf(doc: fitz.Document, output_pdf: str) -> None:
+    """
+    Save doc to output_pdf and close it.
+    If doc was opened from output_pdf, the annotations are appended with an
+    incremental save (kilobytes, no full rewrite). Otherwise, or if the file
+    can't be saved incrementally (e.g. it needed repair), the document is
+    rewritten compacted, via a temp file so a failed save leaves no partial PDF.
+    """
+    if _same_file(doc.name, output_pdf) and doc.can_save_incrementally():
+        doc.saveIncr()
+        doc.close()
+    else:
+        tmp_path = output_pdf + ".tmp"
+        doc.save(
+            tmp_path,
+            garbage=4,
+            deflate=True,
+            deflate_images=True,
+            deflate_fonts=True,
+            clean=True,
+        )
+        doc.close()
+        os.replace(tmp_path, output_pdf)
+    log.info("Saved highlighted PDF to: %s", output_pdf)
+
 
-    doc.save(output_pdf, deflate=True)
+def _extract_range(pdf_path: str, page_indices: List[int]) -> List[Dict[str, any]]:
+    """
+    Worker-process entry point: extract text for the given 0-based page indices.
+    """
+    doc = fitz.open(pdf_path)
+    pages = [
+        {"page": page_num + 1, "text": doc[page_num].get_text("text")}  # 1-based
+        for page_num in page_indices
+    ]
     doc.close()
-    print(f"Saved highlighted PDF to: {output_pdf}")
+    return pages
 
 
 def extract_text_per_page(pdf_path: str) -> List[Dict[str, any]]:
     """
     Extract text from each page of the PDF.
+    Larger documents are split into contiguous page ranges across worker processes.
     
     Returns:
         List of dicts with "page" (1-based) and "text" keys
     """
     doc = fitz.open(pdf_path)
-    pages = []
-    
-    for page_num in range(doc.page_count):
-        page = doc[page_num]
-        text = page.get_text("text")
-        pages.append({
-            "page": page_num + 1,  # 1-based
-            "text": text
-        })
-    
+    page_count = doc.page_count
+    workers = min(8, os.cpu_count() or 1)
+    if page_count < PARALLEL_MIN_PAGES or workers < 2:
+        pages = []
+        for page_num in range(page_count):
+            page = doc[page_num]
+            text = page.get_text("text")
+            pages.append({
+                "page": page_num + 1,  # 1-based
+                "text": text
+            })
+        doc.close()
+        return pages
     doc.close()
-    return pages
 
+    slices = _split_evenly(list(range(page_count)), workers)
+    with ProcessPoolExecutor(max_workers=len(slices)) as ex:
+        results = ex.map(_extract_range, [pdf_path] * len(slices), slices)
+        return [page for part in results for page in part]
+
+
+def _split_evenly(items: List, n: int) -> List[List]:
+    """
+    Split items into at most n contiguous, near-equal slices.
+    """
+    n = max(1, min(n, len(items)))
+    size, extra = divmod(len(items), n)
+    slices = []
+    start = 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(items[start:end])
+        start = end
+    return slices
+
+
+def _render_page_range(pdf_path: str, page_nums: List[int], zoom: float) -> List[bytes]:
+    doc = fitz.open(pdf_path)
+    mat = fitz.Matrix(zoom, zoom)
+    pngs = [
+        doc[page_num - 1].get_pixmap(matrix=mat, alpha=False).tobytes("png")
+        for page_num in page_nums
+    ]
+    doc.close()
+    return pngs
+
+
+def render_pages_png(
+    pdf_path: str,
+    page_nums: List[int],
+    zoom: float = 2.0,
+    max_workers: Optional[int] = None,
+) -> List[bytes]:
+    """
+    Render pages to PNG bytes, spread across worker processes for larger page sets.
+    PyMuPDF holds the GIL while rendering, so threads would not run in parallel;
+    each worker process opens its own document instead.
+
+    Args:
+        pdf_path: Path to PDF file
+        page_nums: 1-based page numbers to render
+        zoom: Render scale factor
+        max_workers: Max worker processes (default: min(8, cpu count))
+
+    Returns:
+        PNG bytes in the same order as page_nums
+    """
+    workers = max_workers or min(8, os.cpu_count() or 1)
+    if len(page_nums) < PARALLEL_MIN_PAGES or workers < 2:
+        return _render_page_range(pdf_path, page_nums, zoom)
+
+    slices = _split_evenly(list(page_nums), workers)
+    with ProcessPoolExecutor(max_workers=len(slices)) as ex:
+        results = ex.map(
+            _render_page_range,
+            [pdf_path] * len(slices),
+            slices,
+            [zoom] * len(slices),
+        )
+        return [png for pngs in results for png in pngs]
@@ -0,0 +1,189 @@
+"""
+Near-duplicate page cache for per-page highlight extraction.
+
+Cover pages, section dividers and pages that differ only in a running header
+or page number get the same highlights. Page text is compared with rapidfuzz
+against pages already processed with the same model and prompt version; a
+close enough match reuses the stored highlights instead of calling the LLM.
+Entries live in the same SQLite file as the exact-match llm_cache.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+import orjson
+from rapidfuzz import fuzz, process
+
+import llm_cache
+
+log = logging.getLogger(__name__)
+
+# Minimum rapidfuzz ratio (0-100) between normalized page texts to reuse results
+SIMILARITY_THRESHOLD = 97
+
+# Pages shorter than this are too generic ("Exhibit 3") to match safely
+MIN_TEXT_CHARS = 200
+
+_enabled = True
+# Cache files whose table has been created by this process
+_initialized_paths = set()
+
+
+def set_enabled(enabled: bool) -> None:
+    """
+    Turn the cache on or off for this process (e.g. for --no-cache).
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _length_slack(length: int) -> int:
+    # ratio >= threshold bounds how far apart the two lengths can be
+    return int(2 * length * (100 - SIMILARITY_THRESHOLD) / SIMILARITY_THRESHOLD) + 1
+
+
+def _quotes_in(highlights: List[Dict], text: str) -> List[Dict]:
+    # The pages differ slightly; drop quotes that fell in the differing part
+    return [h for h in highlights if _normalize(h["quote"]) in text]
+
+
+def _connect() -> sqlite3.Connection:
+    path = llm_cache.CACHE_PATH
+    if path in _initialized_paths:
+        return sqlite3.connect(path, timeout=30)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS pages ("
+        "model TEXT NOT NULL, prompt_version TEXT NOT NULL, text_hash TEXT NOT NULL, "
+        "length INTEGER NOT NULL, text TEXT NOT NULL, highlights TEXT NOT NULL, "
+        "PRIMARY KEY (model, prompt_version, text_hash))"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS pages_lookup ON pages (model, prompt_version, length)"
+    )
+    _initialized_paths.add(path)
+    return conn
+
+
+def group_similar(page_texts: List[str]) -> List[Optional[int]]:
+    """
+    For each page text, the index of an earlier near-identical one to take its
+    highlights from, or None if it has to be processed itself. Lets pages of
+    one document share results before any of them is in the cache.
+    """
+    texts = [_normalize(t) for t in page_texts]
+    groups = []
+    representatives = []
+    for text in texts:
+        if not _enabled or len(text) < MIN_TEXT_CHARS:
+            groups.append(None)
+            continue
+        slack = _length_slack(len(text))
+        candidates = [i for i in representatives if abs(len(texts[i]) - len(text)) <= slack]
+        best = None
+        if candidates:
+            best = process.extractOne(
+                text,
+                [texts[i] for i in candidates],
+                scorer=fuzz.ratio,
+                score_cutoff=SIMILARITY_THRESHOLD,
+            )
+        if best is None:
+            representatives.append(len(groups))
+            groups.append(None)
+        else:
+            groups.append(candidates[best[2]])
+    return groups
+
+
+def reuse(highlights: List[Dict], page_text: str) -> List[Dict]:
+    """
+    The highlights of a near-identical page that also occur in page_text.
+    """
+    return _quotes_in(highlights, _normalize(page_text))
+
+
+def get(model: str, prompt_version: str, page_text: str) -> Optional[List[Dict]]:
+    """
+    Highlights ("quote"/"label" dicts) stored for a near-identical page, or None.
+    For an identical page all stored quotes are returned; otherwise only those
+    that also occur in page_text.
+    """
+    text = _normalize(page_text)
+    if not _enabled or len(text) < MIN_TEXT_CHARS:
+        return None
+
+    text_hash = _text_hash(text)
+    slack = _length_slack(len(text))
+    try:
+        conn = _connect()
+        try:
+            rows = conn.execute(
+                "SELECT text_hash, text, highlights FROM pages "
+                "WHERE model = ? AND prompt_version = ? AND length BETWEEN ? AND ?",
+                (model, prompt_version, len(text) - slack, len(text) + slack),
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        log.warning("Semantic cache read failed: %s", e)
+        return None
+    if not rows:
+        return None
+
+    # Same page text: the stored result is exactly what the LLM returned for it.
+    # The quotes may not be literal substrings (the model normalizes hyphenation
+    # and the like), so they must not go through the filter below.
+    for row_hash, _, stored in rows:
+        if row_hash == text_hash:
+            return orjson.loads(stored)
+
+    best = process.extractOne(
+        text, [row[1] for row in rows], scorer=fuzz.ratio, score_cutoff=SIMILARITY_THRESHOLD
+    )
+    if best is None:
+        return None
+
+    return _quotes_in(orjson.loads(rows[best[2]][2]), text) or None
+
+
+def put(model: str, prompt_version: str, page_text: str, highlights: List[Dict]) -> None:
+    """
+    Remember the highlights extracted for a page. Failures are logged, never raised.
+    """
+    text = _normalize(page_text)
+    if not _enabled or len(text) < MIN_TEXT_CHARS or not highlights:
+        return
+    stored = orjson.dumps([{"quote": h["quote"], "label": h["label"]} for h in highlights])
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO pages "
+                    "(model, prompt_version, text_hash, length, text, highlights) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        model,
+                        prompt_version,
+                        _text_hash(text),
+                        len(text),
+                        text,
+                        stored.decode("utf-8"),
+                    ),
+                )
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        log.warning("Semantic cache write failed: %s", e)